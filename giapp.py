@@ -1,10 +1,11 @@
 from gicameramodel import CameraModel
-import plotly.express as px
+from giglass import D_LINE
 import argparse
-import plotly.graph_objects as go
 
 
-def main():
+def make_parser():
+    ## Returns the argument parser for one camera model.
+    # gibatch uses it to read args.txt style lines.
     parser = argparse.ArgumentParser(description='Arguments for camera model.')
     parser.add_argument('--R1', type=float, required="true",
                     help='Radius of lens on subject side in mm.')
@@ -24,29 +25,37 @@ def main():
                     help='Number of pixels in a row on sensor')
     parser.add_argument('--N', type=int, required="true",
                     help='Number of rays to shoot from point source')
+    parser.add_argument('--wavelength', type=float,
+                    help='Wavelength in nm for --diffraction. Defaults to the d line.')
+    parser.add_argument('--diffraction', action='store_true',
+                    help='Compute the diffraction PSF instead of tracing N rays.')
+    return parser
 
-    args = parser.parse_args()
 
-    camera_model = CameraModel(args.R1, args.R2, args.T, args.OD, args.D2, args.h, args.M, args.D)
-    camera_model.sample_point_source(args.N)
+def show(_sensor, _params):
+    ## Displays a PSF with its parameters.
+    # plotly is imported here so nothing else pays for it.
+    # @param _sensor the M x M array.
+    # @param _params dict with R1, R2, T, OD, D2, D, h, M and N.
+    import plotly.express as px
 
     # Make tthe image gray scale and get rid of coordinates.
-    fig = px.imshow(camera_model.sensor.sensor, binary_string=True)
+    fig = px.imshow(_sensor, binary_string=True)
     fig.update_layout(coloraxis_showscale=False)
     fig.update_xaxes(showticklabels=False)
     fig.update_yaxes(showticklabels=False)
 
     # Display helpful text.
     lines = [
-        "R1:{},".format(args.R1),
-        "R2:{},".format(args.R2),
-        "T:{},".format(args.T),
-        "OD:{},".format(args.OD),
-        "D2:{},".format(args.D2),
-        "D:{},".format(args.D),
-        "h:{},".format(args.h),
-        "M:{}.".format(args.D),
-        "N:{}".format(args.N)
+        "R1:{},".format(_params['R1']),
+        "R2:{},".format(_params['R2']),
+        "T:{},".format(_params['T']),
+        "OD:{},".format(_params['OD']),
+        "D2:{},".format(_params['D2']),
+        "D:{},".format(_params['D']),
+        "h:{},".format(_params['h']),
+        "M:{}.".format(_params['M']),
+        "N:{}".format(_params['N'])
     ]
     dsplayText = '\n'.join(lines)
 
@@ -62,6 +71,18 @@ def main():
     fig.show()
 
 
+def main():
+    args = make_parser().parse_args()
+
+    camera_model = CameraModel(args.R1, args.R2, args.T, args.OD, args.D2, args.h, args.M, args.D)
+    if args.diffraction:
+        camera_model.sample_diffraction(args.wavelength or D_LINE)
+    else:
+        camera_model.sample_point_source(args.N)
+
+    show(camera_model.sensor.sensor, vars(args))
+
+
 
 if __name__ == "__main__":
     main()
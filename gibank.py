@@ -0,0 +1,152 @@
+'''
+    Banks of precomputed PSFs.
+    A bank is a regular grid over (D, D2, field, wavelength). All of its
+    PSFs live in one .npy file, a (n_D, n_D2, n_field, n_wavelength, M, M)
+    stack, next to a .json index with the camera, the axes and the chief ray
+    landings. Readers memory map the stack, so a lookup only pages in the
+    entries it touches and every process on the machine shares the same
+    pages.
+
+    Interpolation is multilinear between the neighbouring entries, in 1 / D
+    for the source distance so a source at infinity is just 0. The field
+    axis holds field angles, which mean the same thing at every D, so
+    blending across D never mixes a source height with a beam slope.
+'''
+import os
+import json
+import itertools
+import numpy as np
+from giglass import D_LINE
+from gicameramodel import CameraModel
+from gifield import field_from_angles
+from gipool import worker_state, pool_map
+
+## @var AXES
+# The grid axes in the order of the stack.
+AXES = ('D', 'D2', 'field', 'wavelength')
+
+def open_worker(_index, _path):
+    ## Worker setup, see gipool. Opens the stack once per worker.
+    return {'index': _index, 'psfs': np.load(_path, mmap_mode='r+')}
+
+def run_task(_task):
+    ## Computes one entry into the stack of this worker.
+    # @param _task the (i, j, k, l) index of the entry.
+    # @return (task, chief ray landing).
+    psf, chief = compute(worker_state['index'], _task)
+    worker_state['psfs'][_task] = psf
+    return (_task, chief)
+
+def compute(_index, _task):
+    ## Returns (psf, chief ray landing) for one entry of a bank index.
+    p = _index['camera']
+    D, D2, field, wavelength = (_index['axes'][name][i] for name, i in zip(AXES, _task))
+    camera = CameraModel(p['R1'], p['R2'], p['T'], p['OD'], D2, p['h'], p['M'], D, p.get('glass'))
+    source = field_from_angles((field, 0.), D)
+    chief = camera.sample_field(p['N'], source, p['grid'], _wavelength=wavelength)
+    return (camera.sensor.sensor, chief)
+
+def index_path(_path):
+    return os.path.splitext(_path)[0] + '.json'
+
+def coordinate(_name, _values):
+    ## Returns the values of an axis in the space they are interpolated in.
+    values = np.asarray(_values, dtype=float)
+    if _name == 'D':
+        return 1 / values
+    return values
+
+## A read only PSF bank.
+class PSFBank:
+    def __init__(self, _path):
+        ## Opens a bank. Nothing is read until a lookup.
+        # @param _path the .npy stack. The index is next to it.
+        with open(index_path(_path)) as f:
+            self.index = json.load(f)
+        self.psfs = np.load(_path, mmap_mode='r')
+        self.axes = {name: np.asarray(self.index['axes'][name], dtype=float) for name in AXES}
+        ## @var chiefs
+        # (n_D, n_D2, n_field, n_wavelength, 2) chief ray landings, see CameraModel.sample_field.
+        self.chiefs = np.asarray(self.index['chiefs'], dtype=float)
+
+    def build(_path, _R1, _R2, _T, _OD, _h, _M, _N, _Ds, _D2s, _fields=(0.,), _wavelengths=(D_LINE,),
+              _glass=None, _grid='square', _dtype=np.float32, _workers=None):
+        ## Computes every PSF of a bank with CameraModel.sample_field and opens it.
+        # @param _path the .npy stack to write.
+        # @param _R1, _R2, _T, _OD, _h, _M the camera, see CameraModel.
+        # @param _N rays per PSF.
+        # @param _Ds, _D2s, _fields, _wavelengths the axes. Fields are field
+        # angles in radians, see gifield.field_from_angles. PSFs are centered
+        # on the chief ray.
+        # @param _glass the lens glass, see Lens.
+        # @param _grid the pupil grid, one of PupilGrid.KINDS.
+        # @param _dtype the dtype of the stack.
+        # @param _workers number of processes. Defaults to the cpu count,
+        # 1 runs everything in this process.
+        index = {
+            'camera': dict(R1=_R1, R2=_R2, T=_T, OD=_OD, h=_h, M=_M, N=_N, glass=_glass, grid=_grid),
+            'axes': {name: [float(v) for v in values] for name, values in zip(AXES, (_Ds, _D2s, _fields, _wavelengths))},
+        }
+        grid_shape = tuple(len(index['axes'][name]) for name in AXES)
+        psfs = np.lib.format.open_memmap(_path, mode='w+', dtype=_dtype, shape=grid_shape + (_M, _M))
+        chiefs = np.full(grid_shape + (2,), np.nan)
+        tasks = list(itertools.product(*(range(n) for n in grid_shape)))
+        psfs.flush()
+        for task, chief in pool_map(run_task, tasks, _workers, open_worker, (index, _path)):
+            chiefs[task] = chief
+
+        psfs.flush()
+        del psfs
+        index['chiefs'] = chiefs.tolist()
+        with open(index_path(_path), 'w') as f:
+            json.dump(index, f)
+        return PSFBank(_path)
+
+    def shape(self):
+        ## Returns the number of values on each axis.
+        return self.psfs.shape[:len(AXES)]
+
+    def neighbours(self, _name, _value):
+        ## Returns [(i, weight), ...] of the one or two entries around _value.
+        # Values outside the axis are clamped to its ends.
+        coords = coordinate(_name, self.axes[_name])
+        if len(coords) == 1:
+            return [(0, 1.)]
+        order = np.argsort(coords)
+        sorted_coords = coords[order]
+        x = float(np.clip(coordinate(_name, _value), sorted_coords[0], sorted_coords[-1]))
+        j = int(np.clip(np.searchsorted(sorted_coords, x) - 1, 0, len(coords) - 2))
+        a = (x - sorted_coords[j]) / (sorted_coords[j + 1] - sorted_coords[j])
+        return [(int(order[j]), 1 - a), (int(order[j + 1]), a)]
+
+    def nearest_index(self, _D, _D2, _field=0., _wavelength=D_LINE):
+        ## Returns the (i, j, k, l) index of the nearest entry.
+        values = (_D, _D2, _field, _wavelength)
+        return tuple(max(self.neighbours(name, value), key=lambda n: n[1])[0]
+                     for name, value in zip(AXES, values))
+
+    def nearest(self, _D, _D2, _field=0., _wavelength=D_LINE):
+        ## Returns the nearest PSF. A read only view of the mapped stack, not a copy.
+        return self.psfs[self.nearest_index(_D, _D2, _field, _wavelength)]
+
+    def weights(self, _D, _D2, _field, _wavelength):
+        ## Returns [(index, weight), ...] of the entries around a point.
+        per_axis = [self.neighbours(name, value) for name, value in zip(AXES, (_D, _D2, _field, _wavelength))]
+        corners = []
+        for combination in itertools.product(*per_axis):
+            weight = np.prod([w for _, w in combination])
+            if weight > 0:
+                corners.append((tuple(i for i, _ in combination), weight))
+        return corners
+
+    def lookup(self, _D, _D2, _field=0., _wavelength=D_LINE):
+        ## Returns the PSF interpolated between its neighbouring entries as a float64 array.
+        # Only those entries are read.
+        psf = np.zeros(self.psfs.shape[len(AXES):])
+        for index, weight in self.weights(_D, _D2, _field, _wavelength):
+            psf += weight * self.psfs[index]
+        return psf
+
+    def chief(self, _D, _D2, _field=0., _wavelength=D_LINE):
+        ## Returns the interpolated chief ray landing (y, z).
+        return sum(weight * self.chiefs[index] for index, weight in self.weights(_D, _D2, _field, _wavelength))
@@ -0,0 +1,173 @@
+'''
+    Headless batch runs of the camera model.
+    Reads many parameter sets and writes one PSF file per set. Plotting
+    libraries are only imported with --show.
+
+    Parameter files can be JSON lines, CSV with a header, or args.txt style
+    with one set of --R1 10 --R2 10 ... arguments per line. Every set needs
+    R1, R2, T, OD, D2, h, M, D and N and may also give a name, a glass, a
+    pupil grid (see gisampling.PupilGrid) to trace in 2D, or diffraction
+    with an optional wavelength in nm for a diffraction PSF (see giwave).
+
+    python3 gibatch.py params.jsonl --out psfs --format png --workers 8
+'''
+import os
+import sys
+import csv
+import json
+import time
+import zlib
+import struct
+import argparse
+import numpy as np
+from gicameramodel import CameraModel
+from giglass import D_LINE
+from gipool import pool_map
+
+## @var FLOATS
+# Parameters that are floats. M and N are ints, anything else a string.
+FLOATS = ('R1', 'R2', 'T', 'OD', 'D2', 'h', 'D')
+
+## @var FORMATS
+# Supported output formats.
+FORMATS = ('npy', 'npz', 'png')
+
+def normalize(_params, _index):
+    ## Returns a parameter set with numbers converted and a name filled in.
+    # @param _params dict read from a file.
+    # @param _index the position of the set in the file.
+    params = {key: value for key, value in _params.items() if value not in (None, '')}
+    for key in FLOATS:
+        params[key] = float(params[key])
+    params['M'] = int(params['M'])
+    params['N'] = int(params['N'])
+    if 'wavelength' in params:
+        params['wavelength'] = float(params['wavelength'])
+    params['diffraction'] = str(params.get('diffraction', False)).lower() in ('1', 'true', 'yes')
+    params.setdefault('name', 'psf_{:05d}'.format(_index))
+    return params
+
+def read_params(_path):
+    ## Returns the list of parameter sets in a JSONL, CSV or args.txt style file.
+    # @param _path the file.
+    with open(_path) as f:
+        if _path.endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        elif _path.endswith('.jsonl') or _path.endswith('.json'):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            from giapp import make_parser
+            parser = make_parser()
+            parser.add_argument('--name')
+            parser.add_argument('--glass')
+            parser.add_argument('--grid')
+            rows = [vars(parser.parse_args(line.split())) for line in f if line.strip()]
+
+    return [normalize(row, i) for i, row in enumerate(rows)]
+
+def compute(_params):
+    ## Returns the PSF and metadata for one parameter set.
+    p = _params
+    start = time.perf_counter()
+    camera = CameraModel(p['R1'], p['R2'], p['T'], p['OD'], p['D2'], p['h'], p['M'], p['D'], p.get('glass'))
+    if p['diffraction']:
+        camera.sample_diffraction(p.get('wavelength', D_LINE))
+    elif p.get('grid'):
+        camera.sample_pupil(p['N'], p['grid'])
+    else:
+        camera.sample_point_source(p['N'])
+
+    metadata = dict(p, lens_miss=camera.lens_miss, tir=camera.tir,
+                    seconds=time.perf_counter() - start, max=float(camera.sensor.sensor.max()))
+    return (camera.sensor.sensor, metadata)
+
+def png_chunk(_kind, _data):
+    return struct.pack('>I', len(_data)) + _kind + _data + struct.pack('>I', zlib.crc32(_kind + _data))
+
+def write_png(_path, _image, _metadata):
+    ## Writes a 16 bit grayscale PNG scaled so the peak is 65535.
+    # The metadata (including the peak, as max) goes in a tEXt chunk.
+    # @param _path the file.
+    # @param _image the 2D array.
+    # @param _metadata dict stored as JSON.
+    peak = _image.max()
+    scaled = np.zeros(_image.shape) if peak <= 0 else _image / peak * 65535
+    pixels = np.round(scaled).astype('>u2')
+    # every row starts with filter type 0.
+    rows = np.concatenate((np.zeros((pixels.shape[0], 1), np.uint8), pixels.view(np.uint8)), axis=1)
+
+    header = struct.pack('>IIBBBBB', pixels.shape[1], pixels.shape[0], 16, 0, 0, 0, 0)
+    with open(_path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(png_chunk(b'IHDR', header))
+        f.write(png_chunk(b'tEXt', b'psf\x00' + json.dumps(_metadata).encode('latin-1')))
+        f.write(png_chunk(b'IDAT', zlib.compress(rows.tobytes())))
+        f.write(png_chunk(b'IEND', b''))
+
+def write(_psf, _metadata, _out, _format):
+    ## Writes one PSF in the given format. Returns the path.
+    # npy gets a .json file of metadata next to it, npz and png carry it inside.
+    path = os.path.join(_out, "{}.{}".format(_metadata['name'], _format))
+    if _format == 'npy':
+        np.save(path, _psf)
+        with open(path[:-4] + '.json', 'w') as f:
+            json.dump(_metadata, f)
+    elif _format == 'npz':
+        np.savez_compressed(path, psf=_psf, metadata=json.dumps(_metadata))
+    else:
+        write_png(path, _psf, _metadata)
+    return path
+
+def run_one(_task):
+    ## Computes and writes one parameter set. Returns (path, metadata).
+    params, out, format = _task
+    psf, metadata = compute(params)
+    return (write(psf, metadata, out, format), metadata)
+
+def run(_params, _out, _format='npy', _workers=None):
+    ## Computes every parameter set over a process pool and writes the results.
+    # @param _params list of parameter sets, see read_params.
+    # @param _out the output directory.
+    # @param _format one of FORMATS.
+    # @param _workers number of processes. Defaults to the cpu count, 1 runs
+    # everything in this process.
+    # @return list of (path, metadata) in the order of _params.
+    assert _format in FORMATS, "run() unknown format {}".format(_format)
+    os.makedirs(_out, exist_ok=True)
+    tasks = [(params, _out, _format) for params in _params]
+    return list(pool_map(run_one, tasks, _workers, _ordered=True))
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch runs of the camera model.')
+    parser.add_argument('params',
+                    help='JSONL, CSV or args.txt style file of parameter sets.')
+    parser.add_argument('--out', default='psfs',
+                    help='Output directory.')
+    parser.add_argument('--format', choices=FORMATS, default='npy',
+                    help='Output format.')
+    parser.add_argument('--workers', type=int, default=None,
+                    help='Number of processes, defaults to the cpu count.')
+    parser.add_argument('--show', action='store_true',
+                    help='Display every PSF after it is written. Imports plotly.')
+
+    args = parser.parse_args()
+    results = run(read_params(args.params), args.out, args.format, args.workers)
+
+    for path, metadata in results:
+        print("{} {:.3f} s".format(path, metadata['seconds']))
+
+    if args.show:
+        from giapp import show
+        for path, metadata in results:
+            if args.format == 'npy':
+                psf = np.load(path)
+            elif args.format == 'npz':
+                psf = np.load(path)['psf']
+            else:
+                psf = compute(metadata)[0]
+            show(psf, metadata)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
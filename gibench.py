@@ -0,0 +1,209 @@
+'''
+    Benchmarks for the tracer with regression tracking.
+    Every case is timed (best of a few repeats), its peak memory measured
+    with tracemalloc, and the results are appended to a JSON history file.
+    Given a baseline the run fails when a case gets slower, or its peak
+    memory grows, by more than the tolerance.
+
+    python3 gibench.py
+    python3 gibench.py --quick --baseline bench_baseline.json
+    python3 gibench.py --update-baseline --baseline bench_baseline.json
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+from gimath import Ray, RayBatch, Circle, Utils
+from gicameramodel import CameraModel, Lens, Sensor
+
+## @var ARGS_FILE
+# The args.txt that ships next to this file.
+ARGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "args.txt")
+
+def read_args(_path=ARGS_FILE):
+    ## Returns the --key value pairs of an args.txt file as a dict.
+    # @param _path the file.
+    with open(_path) as f:
+        tokens = f.read().split()
+    args = {}
+    for key, value in zip(tokens[::2], tokens[1::2]):
+        key = key.lstrip('-')
+        args[key] = int(value) if key in ('M', 'N') else float(value)
+    return args
+
+## A single benchmark.
+# The setup runs outside of the timing. run gets whatever setup returned.
+class Case:
+    def __init__(self, _name, _setup, _run, _rays=0):
+        ## Constructer.
+        # @param _name a unique name, used as the key in the history.
+        # @param _setup returns the state run needs.
+        # @param _run the timed function.
+        # @param _rays the number of rays traced per run, for rays / sec.
+        self.name = _name
+        self.setup = _setup
+        self.run = _run
+        self.rays = _rays
+
+    def measure(self, _repeats):
+        ## Returns a dict with the best time, rays / sec and peak memory.
+        # @param _repeats number of timed runs.
+        best = float('inf')
+        for _ in range(_repeats):
+            state = self.setup()
+            start = time.perf_counter()
+            self.run(state)
+            best = min(best, time.perf_counter() - start)
+
+        # memory is measured separately since tracemalloc slows things down.
+        state = self.setup()
+        tracemalloc.start()
+        self.run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return {
+            'seconds': best,
+            'rays_per_sec': self.rays / best if self.rays and best > 0 else None,
+            'peak_bytes': peak,
+        }
+
+def camera_case(_name, _args, _method='sample_point_source'):
+    ## A case that builds a CameraModel from args.txt style args and samples it.
+    # @param _args dict with R1, R2, T, OD, D2, h, M, D and N.
+    # @param _method the sampling method to call with N.
+    a = _args
+    setup = lambda: CameraModel(a['R1'], a['R2'], a['T'], a['OD'], a['D2'], a['h'], a['M'], a['D'])
+    return Case(_name, setup, lambda camera: getattr(camera, _method)(a['N']), a['N'])
+
+def cases(_quick=False):
+    ## Returns the list of benchmark cases.
+    # @param _quick only use the small sizes.
+    base = read_args()
+    Ns = [100, 10000] if _quick else [100, 10000, 1000000]
+    Ms = [101, 1025] if _quick else [101, 1025, 4097]
+    result = [camera_case("args.txt", base)]
+
+    for N in Ns:
+        result.append(camera_case("sample_point_source N={}".format(N), dict(base, M=101, N=N)))
+        result.append(camera_case("sample_pupil N={}".format(N), dict(base, M=101, N=N), 'sample_pupil'))
+    for M in Ms:
+        result.append(camera_case("sample_point_source M={}".format(M), dict(base, M=M, N=400)))
+
+        def sensor(_M=M):
+            sensor = Sensor(base['h'], _M)
+            sensor.sensor[:, _M // 2] = 1
+            return sensor
+        result.append(Case("Sensor.rotate M={}".format(M), sensor, lambda s: s.rotate()))
+
+    lens = Lens(base['R1'], base['R2'], base['T'], base['OD'])
+    rays = [Ray((500., 0), (-1, slope)) for slope in np.linspace(-.005, .005, 1000)]
+    result.append(Case("Lens.refract", lambda: rays, lambda r: [lens.refract(ray) for ray in r], len(rays)))
+    for N in Ns:
+        batch = RayBatch((500., 0), np.column_stack((-np.ones(N), np.linspace(-.005, .005, N))))
+        result.append(Case("Lens.refract_batch N={}".format(N), lambda b=batch: b, lens.refract_batch, N))
+
+    circle = Circle(0, 0, 10)
+    result.append(Case("Utils.findIntersection", lambda: rays,
+                       lambda r: [Utils.findIntersection(circle, ray) for ray in r], len(rays)))
+    return result
+
+def compare(_results, _baseline, _tolerance, _memory_tolerance=None):
+    ## Returns the cases that got slower or use more memory than the baseline.
+    # Cases and metrics missing from either side are ignored.
+    # @param _results dict of case name to measurement.
+    # @param _baseline dict of case name to measurement.
+    # @param _tolerance allowed relative slow down, .25 is 25%.
+    # @param _memory_tolerance allowed relative growth of the peak memory.
+    # Defaults to _tolerance.
+    # @return list of (name, metric, baseline value, value), metric is
+    # 'seconds' or 'peak_bytes'.
+    tolerances = {'seconds': _tolerance,
+                  'peak_bytes': _tolerance if _memory_tolerance is None else _memory_tolerance}
+    regressions = []
+    for name, result in _results.items():
+        if name not in _baseline:
+            continue
+        for metric, tolerance in tolerances.items():
+            before = _baseline[name].get(metric)
+            if before is not None and result[metric] > before * (1 + tolerance):
+                regressions.append((name, metric, before, result[metric]))
+    return regressions
+
+def run(_cases, _repeats=3, _history=None):
+    ## Measures every case and appends the run to the history file.
+    # @param _cases the cases.
+    # @param _repeats number of timed runs per case.
+    # @param _history the JSON history file, None to not record.
+    # @return dict of case name to measurement.
+    results = {}
+    for case in _cases:
+        results[case.name] = case.measure(_repeats)
+
+    if _history is not None:
+        history = []
+        if os.path.exists(_history):
+            with open(_history) as f:
+                history = json.load(f)
+        history.append({
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'results': results,
+        })
+        with open(_history, 'w') as f:
+            json.dump(history, f, indent=1)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the camera model.')
+    parser.add_argument('--quick', action='store_true',
+                    help='Only run the small sizes.')
+    parser.add_argument('--repeats', type=int, default=3,
+                    help='Number of timed runs per case.')
+    parser.add_argument('--history', default='bench_history.json',
+                    help='JSON file every run gets appended to.')
+    parser.add_argument('--baseline', default=None,
+                    help='JSON file of baseline results to compare against.')
+    parser.add_argument('--tolerance', type=float, default=.25,
+                    help='Allowed relative slow down before failing.')
+    parser.add_argument('--memory-tolerance', type=float, default=None,
+                    help='Allowed relative growth of the peak memory before failing. Defaults to --tolerance.')
+    parser.add_argument('--update-baseline', action='store_true',
+                    help='Write the results to the --baseline file instead of comparing.')
+
+    args = parser.parse_args()
+    if args.update_baseline and args.baseline is None:
+        parser.error('--update-baseline needs --baseline to know which file to write')
+    results = run(cases(args.quick), args.repeats, args.history)
+
+    for name, result in results.items():
+        rate = "" if result['rays_per_sec'] is None else "{:14.0f} rays/s".format(result['rays_per_sec'])
+        print("{:40} {:10.4f} s {:10.1f} MB {}".format(
+            name, result['seconds'], result['peak_bytes'] / 2 ** 20, rate))
+
+    if args.baseline is None:
+        return 0
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        return 0
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance, args.memory_tolerance)
+    for name, metric, before, after in regressions:
+        if metric == 'seconds':
+            print("REGRESSION {}: {:.4f} s -> {:.4f} s".format(name, before, after))
+        else:
+            print("REGRESSION {}: {:.1f} MB -> {:.1f} MB peak".format(name, before / 2 ** 20, after / 2 ** 20))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
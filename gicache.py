@@ -0,0 +1,166 @@
+'''
+    A content addressed cache of PSFs.
+    PSFs are keyed by a hash of every parameter that goes into
+    CameraModel.sample_point_source, the glass and the wavelength it is
+    traced at included, salted with CACHE_VERSION. A bounded in memory LRU tier sits in
+    front of an optional on disk tier of .npy files that are opened memory
+    mapped, so a repeat lookup is a page in rather than a re-trace.
+'''
+import os
+import json
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+from giglass import GLASSES, D_LINE
+from gicameramodel import CameraModel
+
+## @var CACHE_VERSION
+# Part of every key. Bump it when a change to the tracer changes the PSFs,
+# so old disk tiers miss instead of handing out stale PSFs.
+CACHE_VERSION = 2
+
+def glass_params(_glass):
+    ## Returns a json description of a glass, see Lens. A glass is
+    # described by its dispersion model and coefficients, not its name, so
+    # a changed catalog entry changes the key.
+    glass = GLASSES[_glass] if isinstance(_glass, str) else _glass
+    if glass is None:
+        return None
+    return [type(glass).__name__] + [np.asarray(value, dtype=float).tolist()
+                                     for _, value in sorted(vars(glass).items())]
+
+## Hit, miss and eviction counters for a PSFCache.
+class CacheStats:
+    def __init__(self):
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    def __repr__(self):
+        return "CacheStats({})".format(self.__dict__)
+
+## An LRU cache of PSFs with an optional size capped on disk tier.
+class PSFCache:
+    def __init__(self, _max_bytes=256 * 2 ** 20, _path=None, _max_disk_bytes=4 * 2 ** 30):
+        ## Constructer.
+        # @param _max_bytes size cap of the in memory tier.
+        # @param _path directory of the on disk tier. None for memory only.
+        # @param _max_disk_bytes size cap of the on disk tier.
+        self.max_bytes = _max_bytes
+        self.path = _path
+        self.max_disk_bytes = _max_disk_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.stats = CacheStats()
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+    def key(_R1, _R2, _T, _OD, _D2, _h, _M, _D, _N, _glass=None):
+        ## Returns the hash used as the key for these parameters.
+        # Numbers are normalized to floats so 10 and 10.0 share a key.
+        params = [CACHE_VERSION, float(_R1), float(_R2), float(_T), float(_OD), float(_D2),
+                  float(_h), int(_M), float(_D), int(_N), glass_params(_glass), D_LINE]
+        return hashlib.sha256(json.dumps(params).encode()).hexdigest()
+
+    def get(self, _R1, _R2, _T, _OD, _D2, _h, _M, _D, _N, _glass=None):
+        ## Returns the PSF for these parameters, tracing it on a miss.
+        # Same arguments as CameraModel with the ray count before the glass.
+        # The returned array must not be modified, it is shared with the cache.
+        key = PSFCache.key(_R1, _R2, _T, _OD, _D2, _h, _M, _D, _N, _glass)
+
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.stats.memory_hits += 1
+            return self.memory[key]
+
+        psf = self.load(key)
+        if psf is not None:
+            self.stats.disk_hits += 1
+        else:
+            self.stats.misses += 1
+            camera = CameraModel(_R1, _R2, _T, _OD, _D2, _h, _M, _D, _glass)
+            camera.sample_point_source(_N)
+            psf = camera.sensor.sensor
+            self.store(key, psf)
+            # hand out the memory mapped copy so both tiers share pages,
+            # unless another process has already evicted it.
+            mapped = self.load(key, _touch=False)
+            psf = psf if mapped is None else mapped
+
+        psf.flags.writeable = False
+        self.remember(key, psf)
+        return psf
+
+    def remember(self, _key, _psf):
+        ## Puts a PSF in the memory tier, evicting the least recently used.
+        self.memory[_key] = _psf
+        self.memory_bytes += _psf.nbytes
+        while self.memory_bytes > self.max_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted.nbytes
+            self.stats.memory_evictions += 1
+
+    def file(self, _key):
+        return os.path.join(self.path, _key + ".npy")
+
+    def load(self, _key, _touch=True):
+        ## Opens a PSF from the disk tier memory mapped, None if it isn't there.
+        # Other processes may evict it at any time, so that is checked by
+        # opening it rather than up front.
+        # @param _touch mark the file as recently used.
+        if self.path is None:
+            return None
+        try:
+            if _touch:
+                os.utime(self.file(_key))
+            return np.load(self.file(_key), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+    def store(self, _key, _psf):
+        ## Writes a PSF to the disk tier, evicting the least recently used files.
+        if self.path is None:
+            return
+        # write to a file of our own then rename, so readers never see half
+        # a file and processes storing the same key don't write over each other.
+        handle, temp = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.save(f, _psf)
+            os.replace(temp, self.file(_key))
+        except BaseException:
+            os.remove(temp)
+            raise
+
+        # other processes evict from the same directory, files may vanish
+        # between listing and removing them.
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(".npy"):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(self.path, name)))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, name in files[:-1]:
+            if total <= self.max_disk_bytes:
+                break
+            total -= size
+            try:
+                os.remove(name)
+                self.stats.disk_evictions += 1
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        ## Empties the memory tier. The disk tier is kept.
+        self.memory.clear()
+        self.memory_bytes = 0
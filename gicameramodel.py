@@ -1,13 +1,24 @@
 '''
     A single lens model.
     Main components are:
-    1. BiConvex lens.
+    1. BiConvex lens, or any gisystem.System.
     2. A point source light.
     3. A sensor of size h * h in mm and pixel dimension M * M
 '''
+import time
+import json
+import logging
 import numpy as np
 from math import sqrt
 from gimath import *
+from gisampling import PupilGrid, PupilSequence, stratified, stratifiedDisc, adaptiveAngles
+from giglass import GLASSES, D_LINE
+from gistats import TraceStats, stage
+from gisystem import System, Surface
+
+## @var log
+# Diagnostics for misses in the scalar code path.
+log = logging.getLogger(__name__)
 
 ## A sensor of size h * h in milimeters and M * M pixels.
 # Some assumptions have been made. Notably.
@@ -29,7 +40,7 @@ class Sensor:
         # @param _x the x coordinate in mm.
         # @param _y the y coordinate in mm.
         if abs(_x) > self.h / 2 or abs(_y) > self.h / 2:
-            print("Sensor::pixelAt() given out of bounds pixel {} {}".format(_x, _y))
+            log.debug("Sensor::pixelAt() given out of bounds pixel {} {}".format(_x, _y))
             return None
 
         pixelHeight = self.h / self.M
@@ -44,38 +55,126 @@ class Sensor:
         # @param _y the location in y.
         pixel = self.pixelAt(0, _y)
         if pixel == None:
-            print("Sensorr::Write() ray missed sensor")
+            log.debug("Sensor::write() ray missed sensor")
         else:
             self.sensor[pixel[1]][pixel[0]] += 1
 
-    def rotate(self):
-        ## Takes all the readings on (0, y) and rotate them by pi.
+    def write_many(self, _ys, _xs=None, _weights=None):
+        ## Many rays are incident at once.
+        # Same binning as write() but done with a single bincount, and misses
+        # are counted instead of printed. Hits exactly on the far edge of the
+        # sensor land in the last pixel.
+        # @param _ys array of locations in y.
+        # @param _xs array of locations in x. Defaults to the y axis (x = 0).
+        # @param _weights optional per ray weights. Defaults to 1 per ray.
+        # @return (hits, misses). nan locations count as misses.
+        ys = np.asarray(_ys, dtype=float).ravel()
+        xs = np.zeros_like(ys) if _xs is None else np.asarray(_xs, dtype=float).ravel()
+
+        hit = (np.abs(xs) <= self.h / 2) & (np.abs(ys) <= self.h / 2)
+        pixelX = Sensor.pixelRows(-xs[hit], self.h, self.M)
+        pixelY = Sensor.pixelRows(ys[hit], self.h, self.M)
+
+        weights = None if _weights is None else np.asarray(_weights, dtype=float).ravel()[hit]
+        counts = np.bincount(pixelY * self.M + pixelX, weights=weights, minlength=self.M * self.M)
+        self.sensor += counts.reshape(self.M, self.M)
+
+        hits = int(np.count_nonzero(hit))
+        return (hits, ys.size - hits)
+
+    def write_segments(self, _ys0, _ys1, _weights):
+        ## Spreads weight evenly along segments of the y axis.
+        # Segment i covers [_ys0[i], _ys1[i]] and deposits _weights[i] spread
+        # evenly over it, so a pixel gets the share of the segment it overlaps.
+        # Parts off the sensor are lost.
+        # @param _ys0 array of segment starts in mm.
+        # @param _ys1 array of segment ends in mm.
+        # @param _weights array of segment weights.
+        # work in continuous row coordinates, row k covers [k, k + 1).
         pixelHeight = self.h / self.M
-        midX = int(self.M // 2)
+        a = (self.h / 2 - np.asarray(_ys0, dtype=float)) / pixelHeight
+        b = (self.h / 2 - np.asarray(_ys1, dtype=float)) / pixelHeight
+        lo = np.minimum(a, b)
+        hi = np.maximum(a, b)
+        weights = np.asarray(_weights, dtype=float)
+        keep = ~(np.isnan(lo) | np.isnan(hi) | np.isnan(weights))
+        lo, hi, weights = lo[keep], hi[keep], weights[keep]
 
-        #TODO make this cleaner using a map function.
-        for pixelX in range(self.M):
-            # we don't need to rotate the center column.
-            if pixelX == midX:
-                continue
-            xCentered = (pixelX - self.M // 2)
+        # the weight below edge x is sum(d * (ramp(x - lo) - ramp(x - hi)))
+        # with d = weight / length. Very short segments are points.
+        point = hi - lo < 1e-9
+        density = np.where(point, 0, weights / np.where(point, 1, hi - lo))
+        edges = np.arange(self.M + 1)
+
+        def ramps(_starts, _slopes):
+            # sum of _slopes * max(edges - _starts, 0) at every edge.
+            order = np.argsort(_starts)
+            starts = _starts[order]
+            slopes = np.concatenate(([0], np.cumsum(_slopes[order])))
+            moments = np.concatenate(([0], np.cumsum(_slopes[order] * starts)))
+            count = np.searchsorted(starts, edges, side='left')
+            return edges * slopes[count] - moments[count]
+
+        below = ramps(lo, density) - ramps(hi, density)
+        below += np.concatenate(([0], np.cumsum(np.bincount(
+            np.clip(np.floor(lo[point]), -1, self.M).astype(int) + 1,
+            weights=weights[point], minlength=self.M + 2))))[edges + 1]
+        self.sensor[:, self.M // 2] += np.diff(below)
 
-            for pixelY in range(self.M):
-                yCentered = int(self.M // 2 - pixelY)
-                mag = sqrt((xCentered * xCentered) + (yCentered * yCentered))
+    def pixelRows(_ys, _h, _M):
+        ## Returns the row of the pixel for each y in an array, as in pixelAt.
+        # All the ys must be on the sensor. The far edge lands in the last row.
+        # @param _ys array of locations in y.
+        # @param _h the sensor height.
+        # @param _M the number of pixels along x or y.
+        return np.minimum((_h / 2 - _ys) // (_h / _M), _M - 1).astype(int)
 
-                # In the corners of the sensor we can't
-                # get values because the rotation goes off sensor.
-                if mag > (self.M // 2):
-                    continue
+    ## @var radialMaps
+    # Cache of the pixel -> radius maps used by rotate(), keyed by (M, h).
+    radialMaps = {}
 
-                yAxisPixel = int(mag)
-                if xCentered < 0:
-                    # we check the top column of pixels.
-                    self.sensor[pixelY][pixelX] += self.sensor[int(self.M // 2 - yAxisPixel)][midX]
-                else:
-                    # we check the bottom column of pixels.
-                    self.sensor[pixelY][pixelX] += self.sensor[int(self.M // 2 + yAxisPixel)][midX]
+    def radialMap(_M, _h):
+        ## Returns the precomputed mapping from every pixel to the center column.
+        # The map is built once per (M, h) and cached in Sensor.radialMaps.
+        # @param _M the number of pixels along x or y.
+        # @param _h the sensor height.
+        # @return (mask, rows, rows_next, frac). mask is the pixels that get a
+        # value, rows and rows_next the center column rows just inside and
+        # outside the pixel's radius and frac how far between them it is.
+        key = (_M, _h)
+        if key not in Sensor.radialMaps:
+            mid = _M // 2
+            yCentered, xCentered = np.mgrid[mid:mid - _M:-1, -mid:_M - mid]
+            mag = np.sqrt(xCentered * xCentered + yCentered * yCentered)
+
+            # In the corners of the sensor we can't
+            # get values because the rotation goes off sensor.
+            # We also don't need to rotate the center column.
+            mask = (mag <= mid) & (xCentered != 0)
+            yAxisPixel = np.minimum(mag, mid).astype(int)
+            nextPixel = np.minimum(yAxisPixel + 1, mid)
+            frac = np.where(mask, np.minimum(mag, mid) - yAxisPixel, 0)
+
+            # left of center we check the top column of pixels,
+            # right of center the bottom column of pixels.
+            side = np.where(xCentered < 0, -1, 1)
+            Sensor.radialMaps[key] = (mask, mid + side * yAxisPixel, mid + side * nextPixel, frac)
+
+        return Sensor.radialMaps[key]
+
+    def rotate(self, _bilinear=False):
+        ## Takes all the readings on (0, y) and rotate them by pi.
+        # @param _bilinear interpolate between the two nearest center pixels
+        # instead of truncating the radius.
+        mask, rows, rowsNext, frac = Sensor.radialMap(self.M, self.h)
+        column = self.sensor[:, self.M // 2]
+
+        if _bilinear:
+            values = (1 - frac) * column[rows] + frac * column[rowsNext]
+        else:
+            values = column[rows]
+
+        self.sensor += np.where(mask, values, 0)
 
 
 ## A BiConvex lens that models simple ray tracing optics.
@@ -83,41 +182,160 @@ class Sensor:
 # R2: Radius of lens on sensor side.
 # T:  Thickness of lens at center
 # OD: The aperture of the lens.
+# Rays that hit the front surface farther than OD / 2 from the axis, or past
+# the rim where the two surfaces meet, miss the lens.
 # We assume that index of refraction of air is 1.
-class Lens:
-    def __init__(self, _R1, _R2, _T, _OD):
+# This is the two surface preset of a gisystem.System, which does the batch
+# tracing. refract() is the original scalar path.
+class Lens(System):
+    def __init__(self, _R1, _R2, _T, _OD, _glass=None):
         ## Constructer.
         # @param _R1 Radius of lens on subject side.
         # @param _R2 Radius of lens on sensor side.
         # @param _T  Thickness of lens at center
         # @param _OD The aperture of the lens.
+        # @param _glass A name in giglass.GLASSES or a dispersion model.
+        # None for a constant index of 1.5168.
+        self.R1 = _R1
+        self.R2 = _R2
+        self.T = _T
         self.OD = _OD
         self.lens1 = Circle(-_R1 + (_T / 2), 0, _R1)
         self.lens2 = Circle(_R2 - (_T / 2), 0, _R2)
         self.n_air = 1.0
-        self.n_glass = 1.5168
-        #TODO allow for refraction index based off of wavelength.
+        self.glass = GLASSES[_glass] if isinstance(_glass, str) else _glass
+        self.n_glass = 1.5168 if self.glass is None else float(self.glass.index(D_LINE))
+        self.rim = Lens.rimHeight(self.lens1, self.lens2)
+        self.aperture = min(self.OD / 2, self.rim)
+        glass = self.n_glass if self.glass is None else self.glass
+        System.__init__(self, [Surface(_R1, _T, glass, self.aperture), Surface(-_R2, 0)], _OD)
+
+    def rimHeight(_circle1, _circle2):
+        ## Returns the height at which the two surfaces meet, inf if they don't.
+        # Both circles are centered on the optical axis.
+        if _circle1.x1 == _circle2.x1:
+            return inf
+        x = (_circle1.r ** 2 - _circle2.r ** 2 + _circle2.x1 ** 2 - _circle1.x1 ** 2) / (2 * (_circle2.x1 - _circle1.x1))
+        y2 = _circle1.r ** 2 - (x - _circle1.x1) ** 2
+        return sqrt(y2) if y2 > 0 else inf
+
+    def index(self, _wavelength):
+        ## Returns the index of refraction of the glass.
+        # @param _wavelength a wavelength or array of wavelengths in nm.
+        if self.glass is None:
+            return np.full(np.shape(_wavelength), self.n_glass)
+        return self.glass.index(_wavelength)
+
+    def indices(self, _wavelengths=None):
+        ## Returns the index of every gap, air, glass, air. See System.indices.
+        n = self.n_glass if _wavelengths is None else self.index(_wavelengths)
+        return [self.n_air, n, self.n_air]
 
     def refract(self, _ray):
         ## refracts an incoming ray out.
         # We assume the ray is coming in from the right and out of the left.
-        intersection1 = Utils.findIntersection(self.lens1, _ray)[0]
+        # @return the exit ray, or None if the ray misses the aperture, is
+        # tangent to a surface or totally internally reflects.
+        intersections = Utils.findIntersection(self.lens1, _ray)
+        # a tangent ray gives a single point instead of a list.
+        if not isinstance(intersections, list):
+            return None
+        intersection1 = intersections[0]
+        if abs(intersection1[1]) > self.aperture:
+            log.debug("Lens::refract() ray outside of the aperture")
+            return None
         normal1 = self.lens1.getNormal(intersection1[0], intersection1[1])
         inner_ray = Utils.snells2(_ray, normal1, self.n_air, self.n_glass)
+        if inner_ray is None:
+            return None
 
         # Now we calculate the ray that comes out of the left side.
-        intersection2 = Utils.findIntersection(self.lens2, inner_ray)[1]
+        intersections = Utils.findIntersection(self.lens2, inner_ray)
+        if not isinstance(intersections, list):
+            return None
+        intersection2 = intersections[1]
         normal2 = self.lens2.getNormal(intersection2[0], intersection2[1])
         exit_ray = Utils.snells2(inner_ray, normal2, self.n_glass, self.n_air)
 
         return exit_ray
 
 
+## How a progressive run went. See CameraModel.sample_progressive.
+class Progress:
+    def __init__(self):
+        ## @var rays
+        # Rays traced.
+        self.rays = 0
+        ## @var changes
+        # The convergence estimate after each batch.
+        self.changes = []
+        ## @var converged
+        # True if the run stopped because it reached the tolerance.
+        self.converged = False
+        ## @var seconds
+        # Time spent.
+        self.seconds = 0.
+
+    def batches(self):
+        return len(self.changes)
+
+    def __repr__(self):
+        return "Progress(rays={}, batches={}, converged={}, seconds={:.3f})".format(
+            self.rays, self.batches(), self.converged, self.seconds)
+
+
+## The sensor counts of some blocks of a sharded run. See CameraModel.sample_shard.
+class Partial:
+    def __init__(self, _counts, _rays, _blocks, _key):
+        ## @var counts
+        # int64 hits per pixel, or per row of the center column for a fan.
+        self.counts = _counts
+        ## @var rays
+        # Rays traced.
+        self.rays = _rays
+        ## @var blocks
+        # The blocks of the run that were traced, sorted.
+        self.blocks = sorted(_blocks)
+        ## @var key
+        # (N, kind, seed, grid, block, blocks) of the run.
+        self.key = tuple(_key)
+
+    def grid(self):
+        return self.key[3]
+
+    def complete(self):
+        ## True once every block of the run is in.
+        return self.blocks == list(range(self.key[5]))
+
+    def merge(_partials):
+        ## Returns the sum of Partials of the same run.
+        # Raises ValueError if they come from different runs or share a block.
+        partials = list(_partials)
+        key = partials[0].key
+        blocks = [b for partial in partials for b in partial.blocks]
+        if any(partial.key != key for partial in partials):
+            raise ValueError("Partial.merge() partials come from different runs")
+        if len(set(blocks)) != len(blocks):
+            raise ValueError("Partial.merge() partials share blocks")
+        counts = np.sum([partial.counts for partial in partials], axis=0)
+        return Partial(counts, sum(partial.rays for partial in partials), blocks, key)
+
+    def save(self, _path):
+        ## Writes the Partial to an .npz file.
+        np.savez(_path, counts=self.counts, rays=self.rays, blocks=np.array(self.blocks, dtype=np.int64),
+                 key=json.dumps(self.key))
+
+    def load(_path):
+        ## Reads a Partial written by save().
+        with np.load(_path) as f:
+            return Partial(f['counts'], int(f['rays']), f['blocks'].tolist(), json.loads(str(f['key'])))
+
+
 ## The lens, point source object and sensor all in one place.
 # descriptions of new params.
 # D2: Distance from backside of lens to sensor.
 class CameraModel:
-    def __init__(self, _R1, _R2, _T, _OD, _D2, _h, _M, _D):
+    def __init__(self, _R1, _R2, _T, _OD, _D2, _h, _M, _D, _glass=None):
         ## Constructer.
         # @param _R1 Radius of lens on subject side.
         # @param _R2 Radius of lens on sensor side.
@@ -126,13 +344,106 @@ class CameraModel:
         # @param _D2 Distance from back of lens to sensor.
         # @param _h  Height of sensor.
         # @param _M  Number pixels on sensor (M x M)
-        # @param _D  Distance from point source to front of lens.
-        self.lens = Lens(_R1, _R2, _T, _OD)
+        # @param _D  Distance from point source to front of lens. May be inf
+        # for a collimated source.
+        # @param _glass The lens glass, see Lens.
+        self.setup(Lens(_R1, _R2, _T, _OD, _glass), _D2, _h, _M, _D)
+
+    def fromSystem(_system, _D2, _h, _M, _D):
+        ## Builds a camera around any gisystem.System, e.g. a doublet or a
+        # lens with cover glass. D and D2 are measured from its first and
+        # last vertex.
+        camera = CameraModel.__new__(CameraModel)
+        camera.setup(_system, _D2, _h, _M, _D)
+        return camera
+
+    def setup(self, _lens, _D2, _h, _M, _D):
+        ## Places the lens, source and sensor. See the constructer.
+        self.lens = _lens
         self.sensor = Sensor(_h, _M)
-        self.T = _T
-        self.sensor_pos = -_T / 2 - _D2
-        self.source_pos = _T / 2 + _D
+        self.T = _lens.T
+        self.sensor_pos = -self.T / 2 - _D2
+        self.source_pos = self.T / 2 + _D
         self.lens_miss = 0
+        self.tir = 0
+        self.tangent = 0
+        self.stats = None
+
+    def enable_stats(self, _hook=None):
+        ## Starts counting rays and timing stages. Returns the TraceStats.
+        # @param _hook optional profiling hook, see TraceStats.
+        self.stats = TraceStats(_hook)
+        return self.stats
+
+    def collimated(self):
+        ## True if the source is at infinity.
+        return isinf(self.source_pos)
+
+    def theta_max(self):
+        ## Returns the half angle of the launch cone of a finite source.
+        # The cone just fills the stop, see System.cone_angle. Every sampler
+        # sizes its rays from this.
+        return self.lens.cone_angle(self.source_pos - self.T / 2)
+
+    def launch(self, _pupil):
+        ## Returns (origins, directions) of rays through the given pupil coordinates.
+        # A finite source fires every ray from source_pos with slopes up to
+        # tan(theta_max()). A source at infinity fires rays
+        # parallel to the axis spread over the aperture.
+        # @param _pupil (n, 1) or (n, 2) array of pupil coordinates, see PupilGrid.
+        pupil = np.asarray(_pupil, dtype=float)
+        backwards = -np.ones(len(pupil))
+
+        if self.collimated():
+            origins = np.column_stack((np.full(len(pupil), self.T / 2), self.lens.stop_radius() * pupil))
+            return (origins, np.column_stack((backwards, np.zeros_like(pupil))))
+
+        tan_max = tan(self.theta_max())
+        origin = np.zeros(1 + pupil.shape[1])
+        origin[0] = self.source_pos
+        return (origin, np.column_stack((backwards, tan_max * pupil)))
+
+    def trace(self, _origins, _directions, _wavelengths=None):
+        ## Fire rays and return where they cross the sensor plane.
+        # Rays that don't make it through the lens are nan. They are counted
+        # in lens_miss, tir or tangent and never abort the run.
+        # @param _origins (n, k) array of origins, or one shared origin.
+        # @param _directions (n, 2) or (n, 3) array of ray directions.
+        # @param _wavelengths optional per ray wavelengths, see Lens.refract_batch.
+        # @return (n, k) array of points on the sensor plane.
+        with stage(self.stats, 'ray generation'):
+            rays_in = RayBatch(_origins, _directions)
+        if self.stats is not None:
+            self.stats.count('rays', len(rays_in))
+
+        rays_out = self.lens.refract_batch(rays_in, _wavelengths, self.stats)
+
+        with stage(self.stats, 'propagation'):
+            hits = rays_out.pointsAt(self.sensor_pos)
+
+        counts = rays_out.statusCounts()
+        self.lens_miss += int(counts[RAY_MISSED])
+        self.tir += int(counts[RAY_TIR])
+        self.tangent += int(counts[RAY_TANGENT])
+        if self.stats is not None:
+            self.stats.count('lens_misses', counts[RAY_MISSED])
+            self.stats.count('tir', counts[RAY_TIR])
+            self.stats.count('tangent', counts[RAY_TANGENT])
+        return hits
+
+    def deposit(self, _hits, _sensor=None, _weights=None):
+        ## Write points from trace() to a sensor.
+        # @param _hits the points. 3D points use z as the sensor x.
+        # @param _sensor the sensor. Defaults to the camera's sensor.
+        # @param _weights optional per ray weights.
+        sensor = self.sensor if _sensor is None else _sensor
+        with stage(self.stats, 'deposit'):
+            xs = _hits[:, 2] if _hits.shape[1] > 2 else None
+            hits, misses = sensor.write_many(_hits[:, 1], xs, _weights)
+
+        if self.stats is not None:
+            self.stats.count('sensor_hits', hits)
+            self.stats.count('sensor_misses', misses - np.count_nonzero(np.isnan(_hits[:, 0])))
 
     def sample_ray(self, _theta):
         ## Fire a ray form the point source and record where it hits the
@@ -140,20 +451,296 @@ class CameraModel:
         # @param _theta The angle at which it is fired.
         ray_in = Ray((self.source_pos, 0), (-1, tan(_theta)))
         ray_out = self.lens.refract(ray_in)
+        if ray_out is None:
+            self.lens_miss += 1
+            return
 
         sensorYPos = ray_out.getY(self.sensor_pos)
         self.sensor.write(sensorYPos)
 
     def sample_point_source(self, _N):
         ## Fire N rays and record where they hit on the sensor.
+        # A collimated source fires N parallel rays spread over the aperture.
         # @param _N number of rays.
+        self.deposit(self.trace(*self.launch_fan(np.linspace(-1, 1, num = _N))))
 
-        # calculate max angle by using following hueristic.
-        theta_max = atan(self.lens.OD / (self.source_pos + self.T))
-        thetas = np.linspace(-theta_max, theta_max, num = _N)
+        # now rotate the sensor.
+        with stage(self.stats, 'rotate'):
+            self.sensor.rotate()
 
-        for theta in thetas:
-            self.sample_ray(theta)
+    def sample_radial(self, _N, _bilinear=False, _dtype=np.float32):
+        ## Fire N rays like sample_point_source but return a gipsf.RadialPSF.
+        # Only the axial profile is kept, the sensor is not touched.
+        # @param _N number of rays.
+        # @param _bilinear expand with bilinear radial interpolation.
+        # @param _dtype the dtype of the profile.
+        from gipsf import RadialPSF
 
-        # now rotate the sensor.
-        self.sensor.rotate()
+        hits = self.trace(*self.launch_fan(np.linspace(-1, 1, num = _N)))
+
+        with stage(self.stats, 'deposit'):
+            return RadialPSF.fromHeights(hits[:, 1], self.sensor.h, self.sensor.M, None, _bilinear, _dtype)
+
+    def sample_diffraction(self, _wavelength=D_LINE, _samples=None):
+        ## Adds the diffraction PSF from giwave to the sensor.
+        # Unlike the ray sampling it is normalized to 1, less whatever falls
+        # off the sensor.
+        # @param _wavelength wavelength in nm.
+        # @param _samples pupil samples across the diameter, see giwave.diffraction_psf.
+        from giwave import diffraction_psf
+
+        self.sensor.sensor += diffraction_psf(self, _wavelength, _samples)
+
+    def sample_adaptive(self, _N, _max_rays, _threshold=None):
+        ## Fire a fan of rays that is refined where the rays spread out on the sensor.
+        # Like sample_point_source but with gisampling.adaptiveAngles, so
+        # caustics get more rays. Every pair of neighbouring rays that both
+        # reach the lens is treated as a segment weighted by the angle between
+        # them, spread evenly between where the two land. Weights are scaled
+        # so a fan with no losses deposits the number of rays traced.
+        # @param _N number of rays in the starting uniform fan.
+        # @param _max_rays the ray budget.
+        # @param _threshold landing distance in mm that gets refined.
+        # Defaults to one pixel.
+        # @return the number of rays traced.
+        threshold = self.sensor.h / self.sensor.M if _threshold is None else _threshold
+
+        # refined over the fan positions of launch_fan, which are uniform in
+        # angle, or in height for a collimated fan.
+        def heights(_samples):
+            return self.trace(*self.launch_fan(_samples))[:, 1]
+
+        samples, ys = adaptiveAngles(heights, -1, 1, _N, threshold, _max_rays)
+
+        with stage(self.stats, 'deposit'):
+            weights = np.diff(samples) * (len(samples) / 2)
+            self.sensor.write_segments(ys[:-1], ys[1:], weights)
+
+        with stage(self.stats, 'rotate'):
+            self.sensor.rotate()
+        return len(samples)
+
+    def sample_pupil(self, _N, _grid='square', _chunk=65536):
+        ## Fire about N skew rays through a 2D pupil grid and record where they hit.
+        # Unlike sample_point_source this traces the whole pupil in 3D, so no
+        # rotate is needed. Rays are streamed _chunk at a time so memory does
+        # not grow with _N.
+        # @param _N number of rays.
+        # @param _grid the pupil grid, one of PupilGrid.KINDS.
+        # @param _chunk the maximum number of rays traced at once.
+        for pupil in PupilGrid(_N, _grid).chunks(_chunk):
+            self.deposit(self.trace(*self.launch(pupil)))
+
+    def launch_fan(self, _samples):
+        ## Returns (origins, directions) of a meridional fan.
+        # A finite source fires at angles up to theta_max(), a source at
+        # infinity fires parallel rays across the aperture, see launch().
+        # @param _samples positions in [-1, 1] across the fan, the ends are the edge rays.
+        if self.collimated():
+            return self.launch(_samples[:, None])
+        thetas = self.theta_max() * _samples
+        return ((self.source_pos, 0), np.stack((-np.ones(len(_samples)), np.tan(thetas)), axis=1))
+
+    def sample_shard(self, _N, _shard=0, _shards=1, _kind='jittered', _seed=0, _grid=True, _block=65536):
+        ## Traces one shard of a seeded Monte Carlo run without touching the sensor.
+        # The run is a PupilSequence of about _N samples. Shards are disjoint
+        # sets of its blocks, so they can be traced anywhere and merged with
+        # accumulate() into exactly what one process gives.
+        # @param _N number of rays in the whole run.
+        # @param _shard which shard to trace.
+        # @param _shards how many shards the run is cut into.
+        # @param _kind one of PupilSequence.KINDS.
+        # @param _seed the seed.
+        # @param _grid trace skew rays over the 2D pupil instead of a fan that
+        # is rotated once the shards are merged.
+        # @param _block rays per block.
+        # @return a Partial.
+        sequence = PupilSequence(_N, _kind, _seed, 2 if _grid else 1, _block)
+        accumulator = Sensor(self.sensor.h, self.sensor.M)
+        blocks = sequence.shard(_shard, _shards)
+        rays = 0
+        for b in blocks:
+            samples = sequence.block(b)
+            if _grid:
+                self.deposit(self.trace(*self.launch(samples)), accumulator)
+            else:
+                self.deposit(self.trace(*self.launch_fan(samples[:, 0])), accumulator)
+            rays += len(samples)
+
+        # the fan only ever writes to the center column.
+        counts = accumulator.sensor if _grid else accumulator.sensor[:, self.sensor.M // 2]
+        key = (_N, _kind, _seed, bool(_grid), _block, sequence.blocks)
+        return Partial(counts.astype(np.int64), rays, blocks, key)
+
+    def accumulate(self, _partials):
+        ## Merges Partials from sample_shard and adds them to the sensor.
+        # The counts are integers so the order of the merge doesn't matter.
+        # @return the merged Partial.
+        merged = Partial.merge(_partials)
+        accumulator = Sensor(self.sensor.h, self.sensor.M)
+        if merged.grid():
+            accumulator.sensor += merged.counts
+        else:
+            accumulator.sensor[:, self.sensor.M // 2] = merged.counts
+            with stage(self.stats, 'rotate'):
+                accumulator.rotate()
+        self.sensor.sensor += accumulator.sensor
+        return merged
+
+    def sample_stratified(self, _N, _kind='jittered', _seed=0, _grid=True, _block=65536):
+        ## Fire about N seeded Monte Carlo rays in one process. See sample_shard.
+        # @return the Partial of the whole run.
+        return self.accumulate([self.sample_shard(_N, 0, 1, _kind, _seed, _grid, _block)])
+
+    def launch_field(self, _field, _pupil):
+        ## Returns (origins, directions) of rays from an off axis source.
+        # The rays are aimed at points spread a little past the aperture on the
+        # plane of the front vertex, so the stop is always filled.
+        # @param _field (y, z) of the source in mm. For a source at infinity
+        # the (y, z) slopes of the incoming beam instead.
+        # @param _pupil (n, 2) array of pupil coordinates, see PupilGrid.
+        field = np.asarray(_field, dtype=float)
+        targets = np.column_stack((np.full(len(_pupil), self.T / 2), 1.05 * self.lens.aperture * np.asarray(_pupil)))
+        if self.collimated():
+            return (targets, np.tile(np.concatenate(([-1.], -field)), (len(targets), 1)))
+        source = np.concatenate(([self.source_pos], field))
+        return (source, targets - source)
+
+    def chief_ray(self, _field, _wavelength=None):
+        ## Returns where the ray from the source through the center of the stop
+        # lands on the sensor plane as (y, z). nan if it is lost.
+        # @param _field (y, z) of the source, see launch_field.
+        # @param _wavelength optional wavelength in nm.
+        origins, directions = self.launch_field(_field, np.zeros((1, 2)))
+        wavelengths = None if _wavelength is None else np.full(1, float(_wavelength))
+        return self.trace(origins, directions, wavelengths)[0, 1:]
+
+    def sample_field(self, _N, _field, _grid='square', _chunk=65536, _centered=True, _wavelength=None):
+        ## Fire about N skew rays from an off axis point source and record where they hit.
+        # Symmetry doesn't hold off axis so this always traces the full pupil.
+        # @param _N number of rays.
+        # @param _field (y, z) of the source in mm, or slopes for a source at infinity.
+        # @param _grid the pupil grid, one of PupilGrid.KINDS.
+        # @param _chunk the maximum number of rays traced at once.
+        # @param _centered center the sensor on the chief ray instead of the axis.
+        # @param _wavelength optional wavelength in nm for a dispersive lens.
+        # @return the chief ray landing (y, z) on the sensor plane.
+        chief = self.chief_ray(_field, _wavelength)
+        center = np.concatenate(([0], chief)) if _centered and not np.isnan(chief[0]) else 0
+
+        for pupil in PupilGrid(_N, _grid).chunks(_chunk):
+            wavelengths = None if _wavelength is None else np.full(len(pupil), float(_wavelength))
+            self.deposit(self.trace(*self.launch_field(_field, pupil), wavelengths) - center)
+        return chief
+
+    def sensor_points(self, _N, _grid='polar'):
+        ## Trace about N rays through a pupil grid and return where they cross
+        # the sensor plane, without writing to the sensor.
+        # These are what gimetrics works on.
+        # @param _N number of rays.
+        # @param _grid the pupil grid, one of PupilGrid.KINDS.
+        # @return (n, 2) array of (y, z) positions of the rays that made it
+        # through the lens.
+        grid = PupilGrid(_N, _grid)
+        hits = self.trace(*self.launch(grid.points(0, grid.size)))
+        return hits[~np.isnan(hits[:, 0]), 1:]
+
+    def sample_spectrum(self, _N, _wavelengths, _weights=None, _grid=None, _chunk=65536):
+        ## Fire rays at several wavelengths and record a PSF for each.
+        # The rays of all wavelengths are traced in one batch with the
+        # wavelength as an extra axis. The weighted sum is added to the sensor.
+        # @param _N number of rays per wavelength.
+        # @param _wavelengths array of wavelengths in nm.
+        # @param _weights spectral weights. Defaults to a flat spectrum summing to 1.
+        # @param _grid None for the fan of sample_point_source, otherwise the
+        # PupilGrid kind to trace in 2D like sample_pupil.
+        # @param _chunk the maximum number of rays traced at once for a grid.
+        # @return (psfs, total). psfs is (n_wavelengths, M, M) and total is
+        # the weighted sum over wavelengths.
+        wavelengths = np.asarray(_wavelengths, dtype=float).ravel()
+        W = len(wavelengths)
+        weights = np.full(W, 1 / W) if _weights is None else np.asarray(_weights, dtype=float)
+        sensors = [Sensor(self.sensor.h, self.sensor.M) for _ in range(W)]
+
+        if _grid is None:
+            launches = [self.launch_fan(np.linspace(-1, 1, num = _N))]
+        else:
+            launches = (self.launch(pupil) for pupil in PupilGrid(_N, _grid).chunks(max(1, _chunk // W)))
+
+        for origins, directions in launches:
+            n = len(directions)
+            if n == 0:
+                continue
+            # (W, n, k) flattened so every wavelength shares the same rays.
+            directions = np.tile(directions, (W, 1))
+            if np.ndim(origins) == 2:
+                origins = np.tile(origins, (W, 1))
+            hits = self.trace(origins, directions, np.repeat(wavelengths, n))
+
+            for sensor, hit in zip(sensors, hits.reshape(W, n, -1)):
+                self.deposit(hit, sensor)
+
+        if _grid is None:
+            with stage(self.stats, 'rotate'):
+                for sensor in sensors:
+                    sensor.rotate()
+
+        psfs = np.stack([sensor.sensor for sensor in sensors])
+        total = np.tensordot(weights, psfs, axes=1)
+        self.sensor.sensor += total
+        return (psfs, total)
+
+    def sample_progressive(self, _tolerance=1e-3, _batch=10000, _max_rays=10 ** 7,
+                           _time_budget=None, _grid=False, _seed=0, _patience=2):
+        ## Keep adding stratified batches of rays until the PSF stops changing.
+        # After each batch the convergence estimate is the L1 distance between
+        # the normalized PSF before and after it. The run stops once that has
+        # been under _tolerance for _patience batches in a row, or when
+        # _max_rays or _time_budget run out. The result is added to the sensor.
+        # @param _tolerance the convergence tolerance.
+        # @param _batch rays per batch.
+        # @param _max_rays the ray budget.
+        # @param _time_budget optional time budget in seconds.
+        # @param _grid trace skew rays over the 2D pupil instead of a fan that
+        # is rotated at the end.
+        # @param _seed seed of the jitter.
+        # @param _patience batches in a row under the tolerance to stop.
+        # @return a Progress.
+        rng = np.random.default_rng(_seed)
+        progress = Progress()
+        start = time.perf_counter()
+        accumulator = Sensor(self.sensor.h, self.sensor.M)
+        # the fan only ever writes to the center column.
+        view = accumulator.sensor if _grid else accumulator.sensor[:, self.sensor.M // 2]
+        previous = None
+        quiet = 0
+
+        while progress.rays < _max_rays:
+            n = min(_batch, _max_rays - progress.rays)
+            if _grid:
+                pupil = stratifiedDisc(n, rng)
+                self.deposit(self.trace(*self.launch(pupil)), accumulator)
+                n = len(pupil)
+            else:
+                self.deposit(self.trace(*self.launch_fan(stratified(n, rng))), accumulator)
+            progress.rays += n
+
+            total = view.sum()
+            current = view / total if total > 0 else view.copy()
+            change = 1. if previous is None else float(np.abs(current - previous).sum())
+            progress.changes.append(change)
+            previous = current
+
+            quiet = quiet + 1 if change < _tolerance else 0
+            if quiet >= _patience:
+                progress.converged = True
+                break
+            if _time_budget is not None and time.perf_counter() - start > _time_budget:
+                break
+
+        if not _grid:
+            with stage(self.stats, 'rotate'):
+                accumulator.rotate()
+        self.sensor.sensor += accumulator.sensor
+        progress.seconds = time.perf_counter() - start
+        return progress
@@ -0,0 +1,90 @@
+'''
+    Field dependent PSF maps.
+    Off axis the PSF is no longer symmetric, so every field point is traced
+    over the full pupil. Field points are spread over a process pool and
+    each worker writes its PSF straight into a memory mapped (n_fields, M, M)
+    stack, next to the chief ray landing positions.
+'''
+import os
+import shutil
+import tempfile
+import numpy as np
+from gicameramodel import CameraModel
+from gipool import worker_state, pool_map
+
+def open_worker(_map, _path, _shape):
+    ## Worker setup, see gipool. Opens the stack once per worker.
+    return {'map': _map, 'stack': np.memmap(_path, dtype=np.float64, mode='r+', shape=_shape)}
+
+def run_task(_task):
+    ## Computes one field point into the stack of this worker.
+    # @param _task (i, field).
+    # @return (i, chief ray landing).
+    i, field = _task
+    psf, chief = worker_state['map'].psf(field)
+    worker_state['stack'][i] = psf
+    return (i, chief)
+
+def field_grid(_max, _n):
+    ## Returns an _n x _n grid of (y, z) field points over [-_max, _max] squared.
+    values = np.linspace(-_max, _max, _n)
+    y, z = np.meshgrid(values, values, indexing='ij')
+    return np.column_stack((y.ravel(), z.ravel()))
+
+def field_from_angles(_angles, _D):
+    ## Converts (y, z) field angles in radians to source positions at distance _D.
+    # For a source at infinity the field is the slopes of the beam.
+    slopes = np.tan(np.asarray(_angles, dtype=float))
+    return slopes if np.isinf(_D) else slopes * _D
+
+## A camera evaluated over many off axis source positions.
+class FieldMap:
+    def __init__(self, _R1, _R2, _T, _OD, _D2, _h, _M, _D, _N, _grid='square', _glass=None, _centered=True):
+        ## Constructer.
+        # Same camera parameters as CameraModel, then
+        # @param _N number of rays per field point.
+        # @param _grid the pupil grid, one of PupilGrid.KINDS.
+        # @param _glass the lens glass, see Lens.
+        # @param _centered center each PSF on its chief ray instead of the axis.
+        self.params = (_R1, _R2, _T, _OD, _D2, _h, _M, _D, _glass)
+        self.M = _M
+        self.N = _N
+        self.grid = _grid
+        self.centered = _centered
+
+    def psf(self, _field):
+        ## Returns (psf, chief ray landing) for one field point.
+        # @param _field (y, z) of the source in mm, see CameraModel.launch_field.
+        camera = CameraModel(*self.params)
+        chief = camera.sample_field(self.N, _field, self.grid, _centered=self.centered)
+        return (camera.sensor.sensor, chief)
+
+    def run(self, _fields, _path=None, _workers=None):
+        ## Computes the PSF of every field point.
+        # @param _fields (n, 2) array of field points.
+        # @param _path the file backing the stack. If None it is a temporary
+        # file that is unlinked once the stack is done, so it is gone from
+        # the disk when the returned map is dropped.
+        # @param _workers number of processes. Defaults to the cpu count,
+        # 1 runs everything in this process.
+        # @return (psfs, chiefs). psfs is a (n, M, M) memory mapped stack and
+        # chiefs the (n, 2) chief ray landings.
+        if _path is None:
+            directory = tempfile.mkdtemp()
+            try:
+                return self.run(_fields, os.path.join(directory, 'stack.fieldmap'), _workers)
+            finally:
+                # the map outlives its file, the space is freed once it is dropped.
+                shutil.rmtree(directory)
+
+        fields = np.asarray(_fields, dtype=float).reshape(-1, 2)
+        shape = (len(fields), self.M, self.M)
+        stack = np.memmap(_path, dtype=np.float64, mode='w+', shape=shape)
+        chiefs = np.full((len(fields), 2), np.nan)
+        tasks = list(enumerate(fields))
+        stack.flush()
+        for i, chief in pool_map(run_task, tasks, _workers, open_worker, (self, _path, shape)):
+            chiefs[i] = chief
+
+        stack.flush()
+        return (stack, chiefs)
@@ -0,0 +1,58 @@
+'''
+    Dispersion models for lens glasses.
+    All wavelengths are in nm. The formulas themselves use micrometers
+    like the glass catalogs do.
+'''
+import numpy as np
+
+## The Sellmeier equation.
+# n ** 2 = 1 + sum(B_i * l ** 2 / (l ** 2 - C_i)) with l in micrometers.
+class Sellmeier:
+    def __init__(self, _B, _C):
+        ## Constructer.
+        # @param _B the B coefficients.
+        # @param _C the C coefficients in micrometers squared.
+        self.B = np.asarray(_B, dtype=float)
+        self.C = np.asarray(_C, dtype=float)
+
+    def index(self, _wavelength):
+        ## Returns the index of refraction.
+        # @param _wavelength a wavelength or array of wavelengths in nm.
+        l2 = (np.asarray(_wavelength, dtype=float)[..., None] / 1000) ** 2
+        return np.sqrt(1 + np.sum(self.B * l2 / (l2 - self.C), axis=-1))
+
+## The Cauchy equation.
+# n = A + B / l ** 2 + C / l ** 4 with l in micrometers.
+class Cauchy:
+    def __init__(self, _A, _B, _C=0):
+        ## Constructer.
+        # @param _A the constant term.
+        # @param _B the coefficient of l ** -2 in micrometers squared.
+        # @param _C the coefficient of l ** -4 in micrometers to the fourth.
+        self.A = _A
+        self.B = _B
+        self.C = _C
+
+    def index(self, _wavelength):
+        ## Returns the index of refraction.
+        # @param _wavelength a wavelength or array of wavelengths in nm.
+        l2 = (np.asarray(_wavelength, dtype=float) / 1000) ** 2
+        return self.A + self.B / l2 + self.C / (l2 * l2)
+
+## @var GLASSES
+# Some common glasses. Coefficients are from the Schott and Heraeus catalogs.
+GLASSES = {
+    'N-BK7': Sellmeier((1.03961212, 0.231792344, 1.01046945),
+                       (0.00600069867, 0.0200179144, 103.560653)),
+    'N-SF11': Sellmeier((1.73759695, 0.313747346, 1.89878101),
+                        (0.013188707, 0.0623068142, 155.23629)),
+    'N-F2': Sellmeier((1.39757037, 0.159201403, 1.2686543),
+                      (0.00995906143, 0.0546931752, 119.248346)),
+    'fused silica': Sellmeier((0.6961663, 0.4079426, 0.8974794),
+                              (0.004679148, 0.01351206, 97.934003)),
+    'BK7 cauchy': Cauchy(1.5046, 0.00420),
+}
+
+## @var D_LINE
+# The helium d line in nm. Catalog indices like 1.5168 are given here.
+D_LINE = 587.56
@@ -0,0 +1,120 @@
+'''
+    Image formation. Convolves a scene with a PSF using FFT overlap-add.
+    The scene is cut into square tiles, each tile is padded to one fixed FFT
+    size and multiplied by the FFT of the PSF, which is only computed once.
+    Tiles are read from and added into memory mapped .npy files so the
+    memory used depends on the tile size, not the scene size.
+
+    Work is split into bands of tile rows. A band only spills into its
+    neighbours, so even bands run in parallel first and odd bands after.
+'''
+import numpy as np
+from gipool import worker_state, worker_count, open_pool
+
+def open_worker(_convolver, _image, _out):
+    ## Worker setup, see gipool. Opens the input and output once per worker.
+    # @param _image path of the input .npy file.
+    # @param _out path of the output .npy file.
+    return {'convolver': _convolver, 'image': np.load(_image, mmap_mode='r'),
+            'out': np.load(_out, mmap_mode='r+')}
+
+def run_task(_band):
+    ## Convolves one band of tiles into the output of this worker.
+    worker_state['convolver'].band(worker_state['image'], worker_state['out'], _band)
+    return _band
+
+def fast_length(_n):
+    ## Returns the smallest 2, 3, 5 smooth length >= _n, which numpy's FFT handles fastest.
+    n = _n
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+## A PSF ready to be convolved with scenes of any size.
+# Output pixel (y, x) collects the scene through psf[i, j] from (y + cy - i, x + cx - j)
+# where (cy, cx) = (M // 2, M // 2) is the center of the PSF, like Sensor.
+class TiledConvolver:
+    def __init__(self, _psf, _tile=512, _normalize=True):
+        ## Constructer. Takes the FFT of the PSF.
+        # @param _psf a 2D PSF, e.g. Sensor.sensor or RadialPSF.image().
+        # @param _tile the tile size in pixels. Raised to the PSF size if smaller.
+        # @param _normalize scale the PSF to sum to 1 so brightness is kept.
+        psf = np.asarray(_psf, dtype=np.float64)
+        if _normalize and psf.sum() > 0:
+            psf = psf / psf.sum()
+        self.shape = psf.shape
+        self.center = (psf.shape[0] // 2, psf.shape[1] // 2)
+        self.tile = max(_tile, *psf.shape)
+        ## @var fft_shape
+        # The padded size of every tile, big enough for a full linear convolution.
+        self.fft_shape = tuple(fast_length(self.tile + k - 1) for k in psf.shape)
+        self.psf_fft = np.fft.rfft2(psf, self.fft_shape)
+
+    def bands(self, _image):
+        ## Returns the number of bands for an image.
+        return -(-_image.shape[0] // self.tile)
+
+    def band(self, _image, _out, _band):
+        ## Convolves the tiles in one band of _image and adds them into _out.
+        # Overlapping bands must not run at the same time.
+        H, W = _image.shape[:2]
+        ky, kx = self.shape
+        cy, cx = self.center
+        r = _band * self.tile
+        rows = _image[r:r + self.tile]
+
+        for c in range(0, W, self.tile):
+            block = np.asarray(rows[:, c:c + self.tile], dtype=np.float64)
+            full = np.fft.irfft2(np.fft.rfft2(block, self.fft_shape) * self.psf_fft, self.fft_shape)
+            full = full[:block.shape[0] + ky - 1, :block.shape[1] + kx - 1]
+
+            # full convolution index minus the PSF center is the output index.
+            y0, x0 = r - cy, c - cx
+            oy0, ox0 = max(y0, 0), max(x0, 0)
+            oy1, ox1 = min(y0 + full.shape[0], H), min(x0 + full.shape[1], W)
+            _out[oy0:oy1, ox0:ox1] += full[oy0 - y0:oy1 - y0, ox0 - x0:ox1 - x0]
+
+    def convolve(self, _image, _out=None, _workers=None):
+        ## Convolves a whole 2D scene.
+        # @param _image the scene, either an array or the path of a .npy file
+        # which is memory mapped.
+        # @param _out path of the output .npy file, created as float64 with the
+        # shape of the scene. An in memory array is returned if None.
+        # @param _workers number of processes. Defaults to the cpu count.
+        # Only used when both _image and _out are paths; arrays are done here.
+        # @return the convolved scene.
+        image = np.load(_image, mmap_mode='r') if isinstance(_image, str) else np.asarray(_image)
+        if image.ndim != 2:
+            raise ValueError("expected a 2D image, got shape {}".format(image.shape))
+
+        if _out is None:
+            out = np.zeros(image.shape)
+        else:
+            out = np.lib.format.open_memmap(_out, mode='w+', dtype=np.float64, shape=image.shape)
+
+        bands = self.bands(image)
+        workers = worker_count(_workers, (bands + 1) // 2)
+        if workers <= 1 or _out is None or not isinstance(_image, str):
+            for b in range(bands):
+                self.band(image, out, b)
+        else:
+            out.flush()
+            with open_pool(workers, open_worker, (self, _image, _out)) as pool:
+                for phase in (0, 1):
+                    for _ in pool.imap_unordered(run_task, range(phase, bands, 2)):
+                        pass
+            # the workers wrote through their own maps.
+            out = np.load(_out, mmap_mode='r+')
+
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+def convolve(_image, _psf, _out=None, _tile=512, _workers=None):
+    ## Convolves a scene with a PSF, see TiledConvolver.
+    return TiledConvolver(_psf, _tile).convolve(_image, _out, _workers)
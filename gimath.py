@@ -3,11 +3,34 @@
 # All arguments to trig functions are in radians.
 
 from math import *
+import logging
+import numpy as np
+
+## @var log
+# Diagnostics for the scalar code path. Silent unless logging is configured.
+log = logging.getLogger(__name__)
 
 ## @var EPSILON
 # Used to fudge equalities to account for floating point innacuracies.
 EPSILON = .0001
 
+## @var RAY_OK
+# Status codes for every ray in a RayBatch. Once a ray fails it keeps the
+# code of the first failure and its origin and direction become nan.
+RAY_OK = 0
+## @var RAY_MISSED
+# The ray missed a surface or fell outside the aperture.
+RAY_MISSED = 1
+## @var RAY_TIR
+# The ray was totally internally reflected.
+RAY_TIR = 2
+## @var RAY_TANGENT
+# The ray hit a surface orthogonal to its normal.
+RAY_TANGENT = 3
+## @var RAY_STATUS
+# Names of the status codes, indexed by code.
+RAY_STATUS = ('ok', 'missed', 'tir', 'tangent')
+
 ## A class representing a ray from an origin with a direction.
 class Ray:
 
@@ -30,7 +53,7 @@ class Ray:
 
         # check if we are vertical.
         if self.direction[0] == 0:
-            print("getY() called on vertical ray")
+            log.debug("getY() called on vertical ray")
             return None
         else:
             return (_x - self.origin[0]) * (self.direction[1] / self.direction[0]) + self.origin[1]
@@ -41,7 +64,7 @@ class Ray:
 
         # check if horizontal.
         if self.direction[1] == 0:
-            print("getX() called on horizontal ray")
+            log.debug("getX() called on horizontal ray")
             return None
         else:
             return (_y - self.origin[1]) * (self.direction[0] / self.direction[1]) + self.origin[0]
@@ -73,7 +96,7 @@ class Ray:
         # @param _ray the ray to intersect with.
 
         if self.dot(_ray) == 1:
-            print("find_intersection(): given parallel rays")
+            log.debug("find_intersection(): given parallel rays")
             return None
 
         delta1 = self.direction[1] / self.direction[0]
@@ -84,6 +107,75 @@ class Ray:
 
         return (x, y)
 
+## A class representing a batch of rays stored as numpy arrays.
+# Row i of origins and directions is ray i. Rays may be 2D (x, y) or
+# 3D (x, y, z). In both cases x is the optical axis.
+class RayBatch:
+
+    def __init__(self, _origins, _directions, _status=None):
+        ## Constructer
+        # @param _origins (n, k) array of origins, or one origin shared by all rays.
+        # @param _directions (n, k) array of directions. Normalized on construction.
+        # @param _status optional per ray status codes. Defaults to RAY_OK.
+        directions = np.array(_directions, dtype=float, ndmin=2)
+        self.origins = np.array(np.broadcast_to(np.asarray(_origins, dtype=float), directions.shape))
+        self.directions = directions / np.linalg.norm(directions, axis=1)[:, None]
+        if _status is None:
+            self.status = np.zeros(len(directions), dtype=np.int8)
+        else:
+            self.status = np.asarray(_status, dtype=np.int8)
+
+    def __len__(self):
+        return self.origins.shape[0]
+
+    def fromRays(_rays):
+        ## Builds a batch out of a list of Ray objects.
+        # @param _rays the rays.
+        return RayBatch([ray.origin for ray in _rays], [ray.direction for ray in _rays])
+
+    def getRay(self, _i):
+        ## Returns ray _i as a scalar Ray. Only valid for 2D batches.
+        # @param _i the index of the ray.
+        return Ray(tuple(self.origins[_i]), tuple(self.directions[_i]))
+
+    def getY(self, _x):
+        ## Returns the y value of every ray at the given x.
+        # Vertical rays give inf or nan.
+        # @param _x the x value.
+        return self.pointsAt(_x)[:, 1]
+
+    def pointsAt(self, _x):
+        ## Returns the (n, k) points where every ray crosses the plane at _x.
+        # @param _x the x value.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (_x - self.origins[:, 0]) / self.directions[:, 0]
+        return self.origins + t[:, None] * self.directions
+
+    def translate(self, _x, _y):
+        ## Translates every ray by _x and _y.
+        # @param _x how much to translate in x.
+        # @param _y how much to translate in y.
+        self.origins[:, 0] += _x
+        self.origins[:, 1] += _y
+
+    def dot(self, _rays):
+        ## Row wise dot product of the directions of this batch with another.
+        # @param _rays a batch of the same length.
+        return np.einsum('ij,ij->i', self.directions, _rays.directions)
+
+    def select(self, _mask):
+        ## Returns a new batch holding only the rays picked by _mask.
+        # @param _mask a boolean mask or an index array.
+        return RayBatch(self.origins[_mask], self.directions[_mask], self.status[_mask])
+
+    def valid(self):
+        ## Returns the mask of rays that are still RAY_OK.
+        return self.status == RAY_OK
+
+    def statusCounts(self):
+        ## Returns the number of rays with each status code, indexed by code.
+        return np.bincount(self.status, minlength=len(RAY_STATUS))
+
 ## A class representing a circle of the form (x - x1)^2 + (y - y1)^2 = r^2
 class Circle:
 
@@ -122,6 +214,21 @@ class Circle:
 
         return Ray((_x, _y), (_x - self.x1, _y - self.y1))
 
+    def center(self, _k):
+        ## Returns the center as a point in _k dimensions.
+        # The extra dimensions of a 3D sphere are zero.
+        # @param _k the number of dimensions.
+        center = np.zeros(_k)
+        center[0] = self.x1
+        center[1] = self.y1
+        return center
+
+    def getNormalBatch(self, _points):
+        ## Finds the normal lines for a batch of points on the circle.
+        # In 3D this is the normal of the sphere with the same center and radius.
+        # @param _points (n, k) array of points on the edge.
+        return RayBatch(_points, _points - self.center(_points.shape[1]))
+
 
 ## Some helper functions
 class Utils:
@@ -139,7 +246,12 @@ class Utils:
         # @param _theta1 the incident angle.
         # @param _n1 the initial index of refraction.
         # @param _n2 the secondary index of refraction.
-        return asin(_n1 * sin(_theta1) / _n2)
+        # @return the angle, or None on total internal reflection.
+        ratio = _n1 * sin(_theta1) / _n2
+        if abs(ratio) > 1:
+            log.debug("snells(): total internal reflection")
+            return None
+        return asin(ratio)
 
     def snells2(_ray, _normal, _n1, _n2):
         ## Returns a new line that results from this ray refracting into this material.
@@ -147,18 +259,23 @@ class Utils:
         # @param _normal the normal line to the lens.
         # @param _n1 the index of refraction for the initial material.
         # @param _n2 the index of refraction for the refracting material.
+        # @return the refracted ray, or None if the ray is orthogonal to the
+        # normal or totally internally reflects.
 
         # we take the magnitude here because we assume that the angle of incidence
         # is accute.
         dot = abs(_ray.dot(_normal))
 
         if abs(dot) < EPSILON:
-            print("snells2(): incident ray is orthogonal to normal")
-            exit()
+            log.debug("snells2(): incident ray is orthogonal to normal")
+            return None
 
         # find the angle of the new line wr to the original line.
         theta_initial = acos(dot)
-        theta_diff = theta_initial - Utils.snells(theta_initial, _n1, _n2)
+        theta_refracted = Utils.snells(theta_initial, _n1, _n2)
+        if theta_refracted is None:
+            return None
+        theta_diff = theta_initial - theta_refracted
 
         retval1 = Ray(_normal.origin, _ray.direction)
         retval2 = Ray(_normal.origin, _ray.direction)
@@ -207,10 +324,10 @@ class Utils:
         D = (4 * ((m * b) ** 2)) - (4 * (1 + m * m) * (b * b - r * r))
 
         if D < 0:
-            print("findIntersection() found no intersection between circle and ray")
+            log.debug("findIntersection() found no intersection between circle and ray")
             return None
         elif D == 0:
-            print("findIntersection() given a ray tangent to circle")
+            log.debug("findIntersection() given a ray tangent to circle")
             x = (-(2 * m * b)) / (2 * (1 + m * m))
             return (x + origin[0], _ray.getY(x) + origin[1])
         else:
@@ -219,3 +336,61 @@ class Utils:
             y1 = ray_centered.getY(x1)
             y2 = ray_centered.getY(x2)
             return [(x1 + origin[0], y1 + origin[1]), (x2 + origin[0], y2 + origin[1])]
+
+    def findIntersectionBatch(_circle, _rays, _index):
+        ## Finds one intersection point of every ray in a batch with the circle.
+        # Uses the vector form |o + t * d - c| ** 2 = r ** 2 so it works for
+        # both 2D circles and 3D spheres.
+        # @param _circle the circle.
+        # @param _rays a RayBatch.
+        # @param _index 0 for the point farther to the right, 1 for the one to
+        # the left. This matches the order of findIntersection.
+        # @return (n, k) array of points. Rays that miss are nan.
+        offset = _rays.origins - _circle.center(_rays.origins.shape[1])
+        b = np.einsum('ij,ij->i', _rays.directions, offset)
+        c = np.einsum('ij,ij->i', offset, offset) - _circle.r * _circle.r
+        D = b * b - c
+        hit = D >= 0
+        root = np.sqrt(np.where(hit, D, 0))
+
+        t1 = -b + root
+        t2 = -b - root
+        # pick the root by x so the order doesn't depend on the ray direction.
+        x1 = t1 * _rays.directions[:, 0]
+        x2 = t2 * _rays.directions[:, 0]
+        if _index == 0:
+            t = np.where(x1 >= x2, t1, t2)
+        else:
+            t = np.where(x1 >= x2, t2, t1)
+        t = np.where(hit, t, np.nan)
+
+        return _rays.origins + t[:, None] * _rays.directions
+
+    def snellsBatch(_rays, _normals, _n1, _n2):
+        ## Vector form of snells2 for a batch of rays.
+        # t = eta * d + (eta * cos_i - cos_t) * n
+        # Rays whose normal is nan (the surface was missed) are marked
+        # RAY_MISSED, rays orthogonal to the normal RAY_TANGENT and rays that
+        # totally internally reflect RAY_TIR. All of them come back as nan.
+        # @param _rays the incident rays.
+        # @param _normals the normal lines to the lens. Also the new origins.
+        # @param _n1 the index of refraction for the initial material.
+        # @param _n2 the index of refraction for the refracting material.
+        normals = _normals.directions
+        cos_i = -np.einsum('ij,ij->i', _rays.directions, normals)
+
+        # like snells2 we don't care which way the normal points.
+        normals = np.where((cos_i < 0)[:, None], -normals, normals)
+        cos_i = np.abs(cos_i)
+
+        eta = np.broadcast_to(np.asarray(_n1, dtype=float) / np.asarray(_n2, dtype=float), cos_i.shape)
+        k = 1 - eta * eta * (1 - cos_i * cos_i)
+        status = np.select([_rays.status != RAY_OK, np.isnan(_normals.origins[:, 0]), cos_i < EPSILON, k < 0],
+                           [_rays.status, RAY_MISSED, RAY_TANGENT, RAY_TIR], RAY_OK).astype(np.int8)
+        ok = status == RAY_OK
+        cos_t = np.sqrt(np.where(ok, k, 0))
+
+        directions = eta[:, None] * _rays.directions + (eta * cos_i - cos_t)[:, None] * normals
+        directions = np.where(ok[:, None], directions, np.nan)
+
+        return RayBatch(_normals.origins, directions, status)
@@ -0,0 +1,68 @@
+'''
+    Spot metrics computed straight from ray positions on the sensor plane.
+    Everything is O(N) in the number of rays (O(N log N) for the energy
+    curves) and never touches a Sensor grid.
+
+    Points are (n, 2) arrays of (y, z) positions in mm, or (n,) arrays of
+    heights for a meridional fan. Weights are optional per ray weights.
+    Rays with nan positions are ignored.
+'''
+import numpy as np
+
+def prepare(_points, _weights=None):
+    ## Returns the points as (n, k) with nan rays dropped, and their weights.
+    points = np.asarray(_points, dtype=float)
+    if points.ndim == 1:
+        points = points[:, None]
+    keep = ~np.isnan(points).any(axis=1)
+    weights = np.ones(len(points)) if _weights is None else np.asarray(_weights, dtype=float)
+    return (points[keep], weights[keep])
+
+def centroid(_points, _weights=None):
+    ## Returns the weighted centroid.
+    points, weights = prepare(_points, _weights)
+    return weights @ points / weights.sum()
+
+def rms_radius(_points, _weights=None, _center=None):
+    ## Returns the RMS spot radius.
+    # @param _center the point to measure from. Defaults to the centroid.
+    points, weights = prepare(_points, _weights)
+    center = weights @ points / weights.sum() if _center is None else _center
+    offsets = points - center
+    return float(np.sqrt(weights @ np.sum(offsets * offsets, axis=1) / weights.sum()))
+
+def energy_curve(_distances, _weights, _radii):
+    ## Returns the fraction of the weight with distance <= each radius.
+    order = np.argsort(_distances)
+    cumulative = np.concatenate(([0], np.cumsum(_weights[order])))
+    index = np.searchsorted(_distances[order], _radii, side='right')
+    return cumulative[index] / cumulative[-1]
+
+def encircled_energy(_points, _radii, _weights=None, _center=None):
+    ## Returns the fraction of energy inside circles of the given radii.
+    # @param _radii array of radii in mm.
+    # @param _center the center of the circles. Defaults to the centroid.
+    points, weights = prepare(_points, _weights)
+    center = weights @ points / weights.sum() if _center is None else _center
+    distances = np.sqrt(np.sum((points - center) ** 2, axis=1))
+    return energy_curve(distances, weights, np.asarray(_radii, dtype=float))
+
+def ensquared_energy(_points, _half_widths, _weights=None, _center=None):
+    ## Returns the fraction of energy inside squares of the given half widths.
+    # @param _half_widths array of half widths in mm.
+    # @param _center the center of the squares. Defaults to the centroid.
+    points, weights = prepare(_points, _weights)
+    center = weights @ points / weights.sum() if _center is None else _center
+    distances = np.max(np.abs(points - center), axis=1)
+    return energy_curve(distances, weights, np.asarray(_half_widths, dtype=float))
+
+def mtf(_points, _frequencies, _weights=None, _axis=0):
+    ## Returns the geometric MTF along one axis.
+    # This is the magnitude of the Fourier transform of the line spread
+    # function, which for rays is a sum of complex exponentials.
+    # @param _frequencies array of spatial frequencies in cycles / mm.
+    # @param _axis the axis of the points the line spread is taken along.
+    points, weights = prepare(_points, _weights)
+    x = points[:, _axis]
+    phase = np.exp(-2j * np.pi * np.outer(np.asarray(_frequencies, dtype=float), x))
+    return np.abs(phase @ weights) / weights.sum()
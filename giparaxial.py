@@ -0,0 +1,114 @@
+'''
+    Paraxial (ABCD ray transfer matrix) model of a Lens or any
+    gisystem.System, and an autofocus that picks D2 from traced ray heights
+    without touching the Sensor.
+
+    Matrices act on (height, angle) with light going from the source
+    towards the sensor. Radii are positive when the center of curvature is
+    past the surface, so both surfaces of the biconvex lens are +R1, -R2.
+'''
+import numpy as np
+from math import isinf
+from gimath import RayBatch
+from gisampling import PupilGrid
+from gimetrics import rms_radius
+
+def translation(_d):
+    ## Returns the matrix for travelling _d in a constant medium.
+    return np.array([[1., _d], [0., 1.]])
+
+def refraction(_R, _n1, _n2):
+    ## Returns the matrix for refracting at a spherical surface.
+    # @param _R the signed radius.
+    # @param _n1 the index before the surface.
+    # @param _n2 the index after the surface.
+    return np.array([[1., 0.], [(_n1 - _n2) / (_R * _n2), _n1 / _n2]])
+
+## The paraxial model of a Lens or System, from the front vertex to the back vertex.
+class Paraxial:
+    def __init__(self, _lens, _wavelength=None):
+        ## Constructer.
+        # @param _lens the Lens or System.
+        # @param _wavelength optional wavelength in nm for a dispersive lens.
+        self.lens = _lens
+        n = [float(v) for v in _lens.indices(_wavelength)]
+        surfaces = _lens.surfaces
+        self.matrix = np.identity(2)
+        for i, surface in enumerate(surfaces):
+            self.matrix = refraction(surface.R, n[i], n[i + 1]) @ self.matrix
+            if i + 1 < len(surfaces):
+                self.matrix = translation(surface.thickness) @ self.matrix
+
+    def focal_length(self):
+        ## Returns the effective focal length.
+        return -1 / self.matrix[1, 0]
+
+    def back_focal_distance(self):
+        ## Returns the distance from the back vertex to the focus of a collimated beam.
+        A, B = self.matrix[0]
+        C, D = self.matrix[1]
+        return -A / C
+
+    def front_focal_distance(self):
+        ## Returns the distance from the front vertex to the front focus.
+        A, B = self.matrix[0]
+        C, D = self.matrix[1]
+        return -D / C
+
+    def image_distance(self, _D):
+        ## Returns the D2 at which a source at distance _D is in focus.
+        # Negative for sources inside the front focal distance (virtual image).
+        # @param _D distance from the source to the front vertex, may be inf.
+        if isinf(_D):
+            return self.back_focal_distance()
+        A, B = self.matrix[0]
+        C, D = self.matrix[1]
+        return -(A * _D + B) / (C * _D + D)
+
+def pupil_rays(_lens, _D, _N, _grid='polar'):
+    ## Returns a 3D RayBatch from an on axis source that fills the aperture.
+    # @param _lens the Lens.
+    # @param _D distance from the source to the front vertex, may be inf.
+    # @param _N about how many rays.
+    # @param _grid the PupilGrid kind.
+    grid = PupilGrid(_N, _grid)
+    pupil = grid.points(0, grid.size)
+    ones = np.ones(len(pupil))
+    if isinf(_D):
+        origins = np.column_stack((ones * (_lens.T / 2 + 1), _lens.aperture * pupil))
+        return RayBatch(origins, np.column_stack((-ones, 0 * pupil)))
+    return RayBatch((_lens.T / 2 + _D, 0, 0), np.column_stack((-ones, _lens.aperture / _D * pupil)))
+
+def spot(_lens, _rays):
+    ## Traces rays through the lens and returns their heights and slopes at the back vertex.
+    # Heights at a sensor D2 past the back vertex are heights + D2 * slopes.
+    # Rays lost in the lens are dropped.
+    # @return ((n, 2) heights, (n, 2) slopes).
+    out = _lens.refract_batch(_rays)
+    out = out.select(out.valid())
+    heights = out.pointsAt(-_lens.T / 2)[:, 1:]
+    slopes = out.directions[:, 1:] / -out.directions[:, :1]
+    return (heights, slopes)
+
+def rms_spot(_heights, _slopes, _D2):
+    ## Returns the RMS spot radius about the centroid at D2.
+    return rms_radius(_heights + _D2 * _slopes)
+
+def autofocus(_lens, _D, _N=4000, _grid='polar'):
+    ## Returns the D2 that minimizes the RMS spot size of a source at _D.
+    # The lens is traced once. Since heights are linear in D2 the RMS spot
+    # size is a quadratic and its minimum is found in closed form.
+    # @param _lens the Lens.
+    # @param _D distance from the source to the front vertex, may be inf.
+    # @param _N about how many rays to trace.
+    # @param _grid the PupilGrid kind.
+    # @return (D2, rms spot radius at D2). (paraxial D2, nan) if no rays
+    # made it through the lens.
+    heights, slopes = spot(_lens, pupil_rays(_lens, _D, _N, _grid))
+    if len(heights) == 0:
+        return (Paraxial(_lens).image_distance(_D), float('nan'))
+
+    p = heights - heights.mean(axis=0)
+    q = slopes - slopes.mean(axis=0)
+    D2 = -np.sum(p * q) / np.sum(q * q)
+    return (float(D2), rms_spot(heights, slopes, D2))
@@ -0,0 +1,65 @@
+'''
+    Process pools for the sweeps, maps, banks and batches.
+    Every pool here works the same way: each worker runs a setup function
+    once, which opens the memory mapped outputs and keeps whatever the tasks
+    need in worker_state, then tasks are handed out a few at a time. With a
+    single worker the same setup and tasks run in this process, so a serial
+    run takes exactly the path a parallel one does.
+'''
+import os
+import multiprocessing
+
+## @var worker_state
+# What the setup function returned, for the current worker process.
+worker_state = {}
+
+def worker_count(_workers, _tasks):
+    ## Returns how many processes to use.
+    # @param _workers the number asked for. None for the cpu count.
+    # @param _tasks the number of tasks, no more workers than that are started.
+    return max(1, min(_workers or os.cpu_count() or 1, _tasks))
+
+def chunk_size(_tasks, _workers):
+    ## A few tasks per chunk keeps the queue overhead down without leaving
+    # workers idle at the end.
+    return max(1, _tasks // (_workers * 4))
+
+def init_worker(_setup, _args):
+    ## Pool initializer. Fills worker_state from _setup(*_args).
+    worker_state.clear()
+    if _setup is not None:
+        worker_state.update(_setup(*_args))
+
+def open_pool(_workers, _setup=None, _args=()):
+    ## Returns a multiprocessing.Pool whose workers run init_worker.
+    return multiprocessing.Pool(_workers, init_worker, (_setup, _args))
+
+def pool_map(_function, _tasks, _workers=None, _setup=None, _args=(), _ordered=False):
+    ## Yields _function(task) for every task.
+    # @param _function a module level function of one task. It finds what
+    # _setup returned in worker_state.
+    # @param _tasks the tasks.
+    # @param _workers number of processes. Defaults to the cpu count, 1 runs
+    # everything in this process.
+    # @param _setup module level function returning a dict for worker_state.
+    # Memory maps written by the tasks must be flushed before.
+    # @param _args the arguments of _setup.
+    # @param _ordered yield in the order of _tasks instead of as they finish.
+    tasks = list(_tasks)
+    workers = worker_count(_workers, len(tasks))
+    if workers <= 1:
+        init_worker(_setup, _args)
+        try:
+            for task in tasks:
+                yield _function(task)
+        finally:
+            # drop the maps so the caller can delete their files.
+            worker_state.clear()
+        return
+
+    with open_pool(workers, _setup, _args) as pool:
+        chunksize = chunk_size(len(tasks), workers)
+        results = pool.imap(_function, tasks, chunksize) if _ordered else \
+            pool.imap_unordered(_function, tasks, chunksize)
+        for result in results:
+            yield result
@@ -0,0 +1,200 @@
+'''
+    Low latency previews for scrubbing through lens parameters.
+    A request returns a coarse PSF straight away, a few hundred rays on a
+    small sensor, and then refines it on a background thread with more and
+    more rays at the full sensor size. A newer request makes every older
+    one stale, so it stops at its next stage and never reports again.
+
+    Lens geometry is kept between requests. Once a lens has been shown a
+    gitransfer.TransferTable is built for it on a second background thread,
+    so the build never holds up the refinement of a newer request, and later
+    requests that only change D, D2, h, M or N trace through the table.
+'''
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from gicameramodel import CameraModel, Lens
+from gitransfer import TransferTable
+from gipsf import RadialPSF
+
+## One PSF sent to the preview callback.
+class Frame:
+    def __init__(self, _params, _psf, _rays, _final, _table, _seconds):
+        ## @var psf
+        # The M x M image, or smaller for the coarse frame.
+        self.params = _params
+        self.psf = _psf
+        self.rays = _rays
+        ## @var final
+        # True for the last frame of a request.
+        self.final = _final
+        ## @var table
+        # True if the rays went through a cached TransferTable.
+        self.table = _table
+        ## @var seconds
+        # Time since the request.
+        self.seconds = _seconds
+
+    def __repr__(self):
+        return "Frame(rays={}, M={}, final={}, table={}, seconds={:.4f})".format(
+            self.rays, self.psf.shape[0], self.final, self.table, self.seconds)
+
+## Progressive PSFs for a stream of parameter changes.
+class Preview:
+    def __init__(self, _callback=None, _coarse_rays=256, _coarse_M=101, _stages=(16, 4, 1), _tables=8):
+        ## Constructer.
+        # @param _callback called with every Frame that is not stale, from
+        # the caller's thread for the coarse frame and the background thread after.
+        # @param _coarse_rays rays in the coarse frame.
+        # @param _coarse_M the most pixels across the coarse frame.
+        # @param _stages the refinement stages, each traces N / stage rays.
+        # @param _tables how many lenses to keep TransferTables for.
+        self.callback = _callback
+        self.coarse_rays = _coarse_rays
+        self.coarse_M = _coarse_M
+        self.stages = _stages
+        self.max_tables = _tables
+        self.tables = OrderedDict()
+        self.generation = 0
+        self.frame = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1)
+        ## @var builder
+        # Builds TransferTables, one at a time. Only the newest lens waits
+        # for a build, older ones that haven't started are cancelled.
+        self.builder = ThreadPoolExecutor(1)
+        self.building = None
+
+    def lens_key(_params):
+        return (float(_params['R1']), float(_params['R2']), float(_params['T']),
+                float(_params['OD']), _params.get('glass'))
+
+    def table(self, _params):
+        ## Returns the cached TransferTable for the lens, or None.
+        # A table is only used if its error is well under a pixel.
+        key = Preview.lens_key(_params)
+        with self.lock:
+            table = self.tables.get(key)
+            if table is not None:
+                self.tables.move_to_end(key)
+        if table is not None and table.height_error < .1 * _params['h'] / _params['M']:
+            return table
+        return None
+
+    def remember(self, _params):
+        ## Queues a build of the TransferTable for the lens if it isn't cached.
+        # A build of another lens that hasn't started yet is cancelled.
+        key = Preview.lens_key(_params)
+        with self.lock:
+            if key in self.tables:
+                return
+            if self.building is not None:
+                if self.building[0] == key:
+                    return
+                self.building[1].cancel()
+            self.building = (key, self.builder.submit(self.build, key))
+
+    def build(self, _key):
+        ## Builds and caches the TransferTable of one lens, on the builder thread.
+        table = TransferTable(Lens(*_key))
+        with self.lock:
+            self.tables[_key] = table
+            while len(self.tables) > self.max_tables:
+                self.tables.popitem(last=False)
+
+    def trace(self, _params, _N, _M):
+        ## Returns (psf, used table) for _N rays on an _M pixel sensor.
+        p = _params
+        # expanded into a fresh array each time, the frames are not worth a
+        # place in the RadialPSF LRU.
+        table = self.table(p)
+        if table is not None:
+            heights = table.sensor_heights(p['D'], p['D2'], _N)
+            return (RadialPSF.fromHeights(heights, p['h'], _M).expand(), True)
+        camera = CameraModel(p['R1'], p['R2'], p['T'], p['OD'], p['D2'], p['h'], _M, p['D'], p.get('glass'))
+        return (camera.sample_radial(_N).expand(), False)
+
+    def stale(self, _generation):
+        return _generation != self.generation
+
+    def publish(self, _generation, _frame):
+        with self.lock:
+            if self.stale(_generation):
+                return
+            self.frame = _frame
+        if self.callback is not None:
+            self.callback(_frame)
+
+    def request(self, _params):
+        ## Starts a preview and returns its coarse Frame.
+        # @param _params dict with R1, R2, T, OD, D2, h, M, D and N, and optionally glass.
+        start = time.perf_counter()
+        params = dict(_params)
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+
+        M = min(params['M'], self.coarse_M) | 1
+        psf, table = self.trace(params, min(self.coarse_rays, params['N']), M)
+        frame = Frame(params, psf, min(self.coarse_rays, params['N']), False, table, time.perf_counter() - start)
+        self.publish(generation, frame)
+        self.executor.submit(self.refine, generation, params, start)
+        return frame
+
+    def refine(self, _generation, _params, _start):
+        ## The background part of a request.
+        for i, stage in enumerate(self.stages):
+            if self.stale(_generation):
+                return
+            N = max(1, _params['N'] // stage)
+            psf, table = self.trace(_params, N, _params['M'])
+            final = i == len(self.stages) - 1
+            self.publish(_generation, Frame(_params, psf, N, final, table, time.perf_counter() - _start))
+
+        if not self.stale(_generation):
+            self.remember(_params)
+
+    def wait(self, _timeout=None):
+        ## Blocks until the background threads are idle and returns the latest Frame.
+        self.executor.submit(lambda: None).result(_timeout)
+        self.builder.submit(lambda: None).result(_timeout)
+        return self.frame
+
+    def close(self):
+        with self.lock:
+            self.generation += 1
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.builder.shutdown(wait=True, cancel_futures=True)
+
+def explore(_params):
+    ## Sliders and a live PSF for a Jupyter notebook.
+    # ipywidgets and plotly are imported here so nothing else pays for them.
+    # @param _params the starting dict, see Preview.request.
+    import ipywidgets as widgets
+    import plotly.graph_objects as go
+
+    params = dict(_params)
+    figure = go.FigureWidget(go.Heatmap(colorscale='gray', showscale=False))
+    figure.update_xaxes(showticklabels=False)
+    figure.update_yaxes(showticklabels=False, scaleanchor='x')
+
+    def show(_frame):
+        with figure.batch_update():
+            figure.data[0].z = _frame.psf[::-1]
+
+    preview = Preview(show)
+    sliders = []
+    for name in ('R1', 'R2', 'T', 'OD', 'D2', 'D'):
+        slider = widgets.FloatSlider(value=params[name], min=params[name] / 4, max=params[name] * 4,
+                                     step=params[name] / 200, description=name)
+
+        def changed(_change, _name=name):
+            params[_name] = _change['new']
+            preview.request(params)
+
+        slider.observe(changed, names='value')
+        sliders.append(slider)
+
+    preview.request(params)
+    return widgets.VBox(sliders + [figure])
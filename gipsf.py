@@ -0,0 +1,81 @@
+'''
+    Compact PSF representations.
+    An on axis PSF is rotationally symmetric, so everything Sensor.rotate
+    needs is the center column of the sensor. RadialPSF keeps only that and
+    builds the M x M image when it is asked for.
+'''
+from collections import OrderedDict
+import numpy as np
+from gicameramodel import Sensor
+
+## A rotationally symmetric PSF stored as its axial profile.
+# The profile is the center column of the sensor, top row first, exactly
+# what sample_point_source writes before it rotates.
+class RadialPSF:
+
+    ## @var expanded
+    # LRU of the most recently expanded images, shared by every RadialPSF so
+    # a library of PSFs never holds more than max_expanded full images.
+    expanded = OrderedDict()
+    ## @var max_expanded
+    # How many expanded images are kept.
+    max_expanded = 16
+
+    def __init__(self, _profile, _h, _bilinear=False, _dtype=np.float32):
+        ## Constructer.
+        # @param _profile the M values of the center column.
+        # @param _h the sensor height.
+        # @param _bilinear expand with bilinear radial interpolation, see Sensor.rotate.
+        # @param _dtype the dtype to store the profile in.
+        self.profile = np.asarray(_profile, dtype=_dtype)
+        assert self.profile.ndim == 1, "RadialPSF() _profile must be 1D."
+        self.h = _h
+        self.M = len(self.profile)
+        self.bilinear = _bilinear
+
+    def fromHeights(_ys, _h, _M, _weights=None, _bilinear=False, _dtype=np.float32):
+        ## Bins ray heights on the y axis straight into a profile.
+        # Same binning as Sensor.write_many but no M x M grid is allocated.
+        # @param _ys array of heights in mm. Misses and nan are dropped.
+        # @param _h the sensor height.
+        # @param _M the number of pixels along x or y.
+        # @param _weights optional per ray weights.
+        ys = np.asarray(_ys, dtype=float).ravel()
+        hit = np.abs(ys) <= _h / 2
+        weights = None if _weights is None else np.asarray(_weights, dtype=float).ravel()[hit]
+        profile = np.bincount(Sensor.pixelRows(ys[hit], _h, _M), weights=weights, minlength=_M)
+        return RadialPSF(profile, _h, _bilinear, _dtype)
+
+    def fromSensor(_sensor, _bilinear=False, _dtype=np.float32):
+        ## Takes the center column of a sensor that has not been rotated yet.
+        return RadialPSF(_sensor.sensor[:, _sensor.M // 2], _sensor.h, _bilinear, _dtype)
+
+    def nbytes(self):
+        ## Returns the bytes held by the profile.
+        return self.profile.nbytes
+
+    def expand(self):
+        ## Builds the full M x M image. Not cached, see image().
+        sensor = Sensor(self.h, self.M)
+        sensor.sensor[:, self.M // 2] = self.profile
+        sensor.rotate(self.bilinear)
+        return sensor.sensor.astype(self.profile.dtype, copy=False)
+
+    def image(self):
+        ## Returns the full M x M image, through the shared LRU of expansions.
+        # The returned array is read only since it is shared.
+        cache = RadialPSF.expanded
+        if self in cache:
+            cache.move_to_end(self)
+            return cache[self]
+
+        image = self.expand()
+        image.flags.writeable = False
+        cache[self] = image
+        while len(cache) > RadialPSF.max_expanded:
+            cache.popitem(last=False)
+        return image
+
+    def release(self):
+        ## Drops this PSF's expanded image from the cache.
+        RadialPSF.expanded.pop(self, None)
@@ -0,0 +1,214 @@
+'''
+    Launch patterns for rays leaving the point source.
+    Pupil coordinates are (u, v) in the unit disc. They get scaled by the
+    tangent of the maximum launch angle to become ray directions.
+'''
+import numpy as np
+from math import sqrt, pi, ceil, floor
+
+## A 2D grid of pupil samples that can be generated in chunks.
+# Every grid point has a flat index in [0, size). Any index range can be turned
+# into points without building the rest of the grid, so the memory used only
+# depends on the chunk size. Points that land outside the unit disc are dropped.
+# Kinds:
+# square: a square grid of cell centers.
+# hex:    a hexagonal grid, every other row offset by half a spacing.
+# polar:  rings of 6k points at radius k, plus the center.
+class PupilGrid:
+
+    KINDS = ('square', 'hex', 'polar')
+
+    def __init__(self, _N, _kind='square'):
+        ## Constructer
+        # The spacing is picked so that about _N points land in the disc.
+        # @param _N the requested number of rays.
+        # @param _kind one of PupilGrid.KINDS.
+        assert _kind in PupilGrid.KINDS, "PupilGrid() unknown kind {}".format(_kind)
+        assert _N > 0, "PupilGrid() _N must be positive."
+        self.kind = _kind
+
+        if _kind == 'square':
+            self.cols = max(1, ceil(sqrt(4 * _N / pi)))
+            self.rows = self.cols
+            self.size = self.rows * self.cols
+        elif _kind == 'hex':
+            # each point covers a hexagon of area spacing ** 2 * sqrt(3) / 2.
+            self.spacing = sqrt(2 * pi / (sqrt(3) * _N))
+            self.rowHeight = self.spacing * sqrt(3) / 2
+            self.rows = 2 * floor(1 / self.rowHeight) + 1
+            self.cols = 2 * floor(1 / self.spacing) + 2
+            self.size = self.rows * self.cols
+        else:
+            # 1 + 3 * K * (K + 1) points for K rings.
+            self.rings = max(0, round((-3 + sqrt(9 + 12 * (_N - 1))) / 6))
+            # the flat index of the first point of each ring. Ring 0 is the center.
+            k = np.arange(self.rings + 1)
+            self.ringStarts = np.where(k > 0, 1 + 3 * k * (k - 1), 0)
+            self.size = 1 + 3 * self.rings * (self.rings + 1)
+
+    def points(self, _start, _stop):
+        ## Returns the (m, 2) points for flat indices [_start, _stop) that are in the disc.
+        # @param _start the first index.
+        # @param _stop one past the last index.
+        index = np.arange(_start, min(_stop, self.size))
+
+        if self.kind == 'square':
+            u = (2 * (index % self.cols) + 1) / self.cols - 1
+            v = (2 * (index // self.cols) + 1) / self.rows - 1
+        elif self.kind == 'hex':
+            row = index // self.cols - self.rows // 2
+            col = index % self.cols - self.cols // 2
+            u = (col + 0.5 * (row % 2)) * self.spacing
+            v = row * self.rowHeight
+        else:
+            ring = np.searchsorted(self.ringStarts, index, side='right') - 1
+            position = index - self.ringStarts[ring]
+            angle = 2 * pi * position / np.maximum(6 * ring, 1)
+            radius = ring / (self.rings + 0.5)
+            u = radius * np.cos(angle)
+            v = radius * np.sin(angle)
+
+        inside = u * u + v * v <= 1
+        return np.stack((u[inside], v[inside]), axis=1)
+
+    def chunks(self, _chunk):
+        ## Yields the points of the grid at most _chunk at a time.
+        # @param _chunk the number of indices per chunk.
+        for start in range(0, self.size, _chunk):
+            yield self.points(start, start + _chunk)
+
+def stratified(_n, _rng):
+    ## Returns _n jittered samples in [-1, 1], one in each of _n equal strata.
+    # @param _n the number of samples.
+    # @param _rng a numpy Generator.
+    return (np.arange(_n) + _rng.random(_n)) * (2 / _n) - 1
+
+def stratifiedDisc(_n, _rng):
+    ## Returns about _n jittered samples in the unit disc.
+    # The square around the disc is split into equal cells with one sample
+    # in each, and samples outside the disc are dropped.
+    # @param _n the number of samples.
+    # @param _rng a numpy Generator.
+    side = max(1, ceil(sqrt(4 * _n / pi)))
+    row, col = np.divmod(np.arange(side * side), side)
+    u = (col + _rng.random(side * side)) * (2 / side) - 1
+    v = (row + _rng.random(side * side)) * (2 / side) - 1
+    inside = u * u + v * v <= 1
+    return np.stack((u[inside], v[inside]), axis=1)
+
+def radicalInverse(_index, _base):
+    ## Returns the van der Corput radical inverse of every index in a base.
+    # @param _index array of non negative ints.
+    # @param _base the base.
+    index = np.array(_index, dtype=np.int64)
+    result = np.zeros(index.shape)
+    scale = 1 / _base
+    while np.any(index > 0):
+        result += (index % _base) * scale
+        index //= _base
+        scale /= _base
+    return result
+
+## A seeded sequence of pupil samples cut into fixed blocks.
+# Every sample only depends on the seed and its index, so any set of blocks
+# gives the same samples wherever and in whatever order it is generated.
+# 2D samples are in the unit disc, 1D samples in [-1, 1] like a fan.
+# Kinds:
+# jittered: one uniform sample in each of about N equal cells. In 2D the
+#           cells cover the square around the disc and samples outside are dropped.
+# halton:   the Halton sequence (bases 2 and 3) shifted by a seeded offset.
+# random:   independent uniform samples.
+class PupilSequence:
+
+    KINDS = ('jittered', 'halton', 'random')
+
+    def __init__(self, _N, _kind='jittered', _seed=0, _dims=2, _block=65536):
+        ## Constructer
+        # @param _N the requested number of samples.
+        # @param _kind one of PupilSequence.KINDS.
+        # @param _seed the seed.
+        # @param _dims 2 for the pupil disc, 1 for a fan.
+        # @param _block samples per block.
+        assert _kind in PupilSequence.KINDS, "PupilSequence() unknown kind {}".format(_kind)
+        assert _N > 0, "PupilSequence() _N must be positive."
+        self.kind = _kind
+        self.seed = _seed
+        self.dims = _dims
+        self.block_size = _block
+        if _kind == 'jittered' and _dims == 2:
+            self.side = max(1, ceil(sqrt(4 * _N / pi)))
+            self.size = self.side * self.side
+        else:
+            self.size = _N
+        self.blocks = -(-self.size // _block)
+        self.shift = np.random.default_rng(_seed).random(_dims)
+
+    def shard(self, _shard, _shards):
+        ## Returns the blocks of one of _shards disjoint, contiguous shards.
+        return list(range(self.blocks * _shard // _shards, self.blocks * (_shard + 1) // _shards))
+
+    def block(self, _b):
+        ## Returns the (m, dims) samples of block _b.
+        index = np.arange(_b * self.block_size, min((_b + 1) * self.block_size, self.size))
+        if self.kind == 'halton':
+            u = np.stack([radicalInverse(index + 1, base) for base in (2, 3)[:self.dims]], axis=1)
+            u = (u + self.shift) % 1
+        else:
+            u = np.random.default_rng([self.seed, _b]).random((len(index), self.dims))
+            if self.kind == 'jittered':
+                if self.dims == 1:
+                    u[:, 0] = (index + u[:, 0]) / self.size
+                else:
+                    row, col = np.divmod(index, self.side)
+                    samples = np.stack((col + u[:, 0], row + u[:, 1]), axis=1) * (2 / self.side) - 1
+                    return samples[np.sum(samples * samples, axis=1) <= 1]
+
+        if self.dims == 1:
+            return 2 * u - 1
+        # area preserving map from the unit square to the disc.
+        r = np.sqrt(u[:, 0])
+        return np.stack((r * np.cos(2 * pi * u[:, 1]), r * np.sin(2 * pi * u[:, 1])), axis=1)
+
+def adaptiveAngles(_trace, _lo, _hi, _n, _threshold, _max_rays, _max_levels=20):
+    ## Samples angles in [_lo, _hi] more densely where neighbouring rays land far apart.
+    # Starts from _n uniform angles. Every level, each interval gets a ray in
+    # its middle if its two rays land more than _threshold apart, if the
+    # landing height turns around in it (a caustic) or if one of its rays is
+    # lost and the other is not. Stops when nothing needs refining, or at
+    # _max_rays or _max_levels.
+    # @param _trace function from an array of angles to landing heights (nan if lost).
+    # @param _lo the smallest angle.
+    # @param _hi the largest angle.
+    # @param _n the number of starting angles.
+    # @param _threshold the landing distance that triggers a refinement.
+    # @param _max_rays the ray budget.
+    # @param _max_levels the most levels of refinement.
+    # @return (angles, heights), sorted by angle.
+    angles = np.linspace(_lo, _hi, num = _n)
+    heights = _trace(angles)
+
+    for _ in range(_max_levels):
+        step = np.diff(heights)
+        gap = np.abs(step)
+        lost = np.isnan(heights)
+        refine = (gap > _threshold) | (lost[1:] != lost[:-1])
+        # where the height turns around refine on both sides.
+        turn = np.sign(step[1:]) * np.sign(step[:-1]) < 0
+        refine[1:] |= turn
+        refine[:-1] |= turn
+
+        budget = _max_rays - len(angles)
+        if budget <= 0 or not np.any(refine):
+            break
+
+        # spend what is left on the widest landing gaps first.
+        candidates = np.flatnonzero(refine)
+        if len(candidates) > budget:
+            order = np.argsort(-np.nan_to_num(gap[candidates], nan=np.inf), kind='stable')
+            candidates = np.sort(candidates[order[:budget]])
+        middles = (angles[candidates] + angles[candidates + 1]) / 2
+
+        angles = np.insert(angles, candidates + 1, middles)
+        heights = np.insert(heights, candidates + 1, _trace(middles))
+
+    return (angles, heights)
@@ -0,0 +1,72 @@
+'''
+    Instrumentation for the trace pipeline.
+    Counts where rays are lost and times every stage. Off by default: code
+    that is handed no TraceStats uses NULL_STAGE, which does nothing.
+'''
+import time
+from contextlib import nullcontext
+
+## @var NULL_STAGE
+# The stage used when stats are off. Shared and reusable.
+NULL_STAGE = nullcontext()
+
+## Times one pass through a stage and adds it to a TraceStats.
+class StageTimer:
+    def __init__(self, _stats, _name):
+        self.stats = _stats
+        self.name = _name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc):
+        seconds = time.perf_counter() - self.start
+        stats = self.stats
+        stats.seconds[self.name] = stats.seconds.get(self.name, 0) + seconds
+        stats.calls[self.name] = stats.calls.get(self.name, 0) + 1
+        if stats.hook is not None:
+            stats.hook(self.name, seconds)
+        return False
+
+## Ray counters and stage timings for a run.
+# counts:
+# rays:          rays launched from the source.
+# lens_misses:   rays that missed a lens surface or the aperture.
+# tir:           rays that were totally internally reflected.
+# tangent:       rays that hit a surface orthogonal to its normal.
+# sensor_hits:   rays that made it through the lens and onto the sensor.
+# sensor_misses: rays that made it through the lens but missed the sensor.
+class TraceStats:
+
+    STAGES = ('ray generation', 'surface 1', 'surface 2', 'propagation', 'deposit', 'rotate')
+
+    def __init__(self, _hook=None):
+        ## Constructer.
+        # @param _hook optional profiling hook called as _hook(stage, seconds)
+        # every time a stage finishes.
+        self.hook = _hook
+        self.counts = {'rays': 0, 'lens_misses': 0, 'tir': 0, 'tangent': 0, 'sensor_hits': 0, 'sensor_misses': 0}
+        self.seconds = {}
+        self.calls = {}
+
+    def count(self, _name, _n):
+        ## Adds _n to a counter.
+        self.counts[_name] += int(_n)
+
+    def stage(self, _name):
+        ## Returns a context manager that times the stage _name.
+        return StageTimer(self, _name)
+
+    def report(self):
+        ## Returns a human readable summary.
+        lines = ["{:16} {}".format(name, count) for name, count in self.counts.items()]
+        for name in sorted(self.seconds, key=lambda name: -self.seconds[name]):
+            lines.append("{:16} {:10.6f} s {:6} calls".format(name, self.seconds[name], self.calls[name]))
+        return '\n'.join(lines)
+
+def stage(_stats, _name):
+    ## Returns a timer for the stage, or NULL_STAGE if _stats is None.
+    # @param _stats a TraceStats or None.
+    # @param _name the stage.
+    return NULL_STAGE if _stats is None else _stats.stage(_name)
@@ -0,0 +1,90 @@
+'''
+    Sweeps of the camera model over many (D, D2) pairs.
+    Every pair is an independent CameraModel so they are spread over a
+    process pool. Workers write their PSF straight into a memory mapped
+    (n_D, n_D2, M, M) stack so no arrays are pickled back to the parent.
+'''
+import os
+import shutil
+import tempfile
+import numpy as np
+from gicameramodel import CameraModel
+from gipool import worker_state, pool_map
+
+def open_worker(_sweep, _path, _shape):
+    ## Worker setup, see gipool. Opens the stack once per worker.
+    # @param _sweep the FocusSweep being run.
+    # @param _path the stack file.
+    # @param _shape the stack shape.
+    return {'sweep': _sweep, 'stack': np.memmap(_path, dtype=np.float64, mode='r+', shape=_shape)}
+
+def run_task(_task):
+    ## Computes one (D, D2) pair into the stack of this worker.
+    # @param _task (i, j, D, D2).
+    i, j, D, D2 = _task
+    stack = worker_state['stack']
+    stack[i, j] = worker_state['sweep'].psf(D, D2)
+    return (i, j)
+
+## A fixed lens and sensor evaluated over a grid of source and sensor distances.
+class FocusSweep:
+    def __init__(self, _R1, _R2, _T, _OD, _h, _M, _N, _grid=None):
+        ## Constructer.
+        # @param _R1 Radius of lens on subject side.
+        # @param _R2 Radius of lens on sensor side.
+        # @param _T  Thickness of lens at center
+        # @param _OD The aperture of the lens.
+        # @param _h  Height of sensor.
+        # @param _M  Number pixels on sensor (M x M)
+        # @param _N  Number of rays per PSF.
+        # @param _grid None to use sample_point_source, 'diffraction' for
+        # sample_diffraction, otherwise the PupilGrid kind passed to sample_pupil.
+        self.R1 = _R1
+        self.R2 = _R2
+        self.T = _T
+        self.OD = _OD
+        self.h = _h
+        self.M = _M
+        self.N = _N
+        self.grid = _grid
+
+    def psf(self, _D, _D2):
+        ## Returns the sensor for one (D, D2) pair.
+        # @param _D  Distance from point source to front of lens.
+        # @param _D2 Distance from back of lens to sensor.
+        camera = CameraModel(self.R1, self.R2, self.T, self.OD, _D2, self.h, self.M, _D)
+        if self.grid is None:
+            camera.sample_point_source(self.N)
+        elif self.grid == 'diffraction':
+            camera.sample_diffraction()
+        else:
+            camera.sample_pupil(self.N, self.grid)
+        return camera.sensor.sensor
+
+    def run(self, _Ds, _D2s, _path=None, _workers=None):
+        ## Computes the PSF for every (D, D2) pair.
+        # @param _Ds the source distances.
+        # @param _D2s the sensor distances.
+        # @param _path the file backing the stack. If None it is a temporary
+        # file that is unlinked once the stack is done, so it is gone from
+        # the disk when the returned map is dropped.
+        # @param _workers number of processes. Defaults to the cpu count,
+        # 1 runs everything in this process.
+        # @return a (len(_Ds), len(_D2s), M, M) memory mapped stack.
+        if _path is None:
+            directory = tempfile.mkdtemp()
+            try:
+                return self.run(_Ds, _D2s, os.path.join(directory, 'stack.psfstack'), _workers)
+            finally:
+                # the map outlives its file, the space is freed once it is dropped.
+                shutil.rmtree(directory)
+
+        shape = (len(_Ds), len(_D2s), self.M, self.M)
+        stack = np.memmap(_path, dtype=np.float64, mode='w+', shape=shape)
+        tasks = [(i, j, D, D2) for i, D in enumerate(_Ds) for j, D2 in enumerate(_D2s)]
+        stack.flush()
+        for _ in pool_map(run_task, tasks, _workers, open_worker, (self, _path, shape)):
+            pass
+
+        stack.flush()
+        return stack
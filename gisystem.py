@@ -0,0 +1,176 @@
+'''
+    Sequential optical systems.
+    An ordered list of spherical and flat surfaces from the source to the
+    sensor, each followed by a gap of some thickness filled with some
+    medium. A RayBatch is traced surface by surface, one vectorized
+    intersection and Snell step per surface, so doublets, triplets and cover
+    glass cost a few array operations per surface.
+
+    Like Lens the system is centered on the origin: the first vertex is at
+    x = T / 2 and the last at x = -T / 2, where T is the distance between
+    them. Radii are positive when the center of curvature is past the
+    surface, like giparaxial, so the biconvex Lens is +R1, -R2.
+'''
+import numpy as np
+from math import inf, isinf, sqrt, atan
+from gimath import RayBatch, Circle, Utils
+from giglass import GLASSES, D_LINE
+from gistats import stage
+
+def index_of(_medium, _wavelengths=None):
+    ## Returns the index of refraction of a medium.
+    # @param _medium None for air, a number, a name in giglass.GLASSES or a
+    # dispersion model.
+    # @param _wavelengths a wavelength or array of wavelengths in nm. None
+    # for the d line.
+    if _medium is None or isinstance(_medium, (int, float)):
+        n = 1.0 if _medium is None else float(_medium)
+        return n if _wavelengths is None else np.full(np.shape(_wavelengths), n)
+    glass = GLASSES[_medium] if isinstance(_medium, str) else _medium
+    if _wavelengths is None:
+        return float(glass.index(D_LINE))
+    return glass.index(_wavelengths)
+
+## One refracting surface and the gap after it.
+class Surface:
+    def __init__(self, _R, _thickness, _medium=None, _aperture=inf, _x=0.):
+        ## Constructer.
+        # @param _R the signed radius, inf for a flat surface.
+        # @param _thickness distance along the axis to the next surface.
+        # @param _medium what fills the gap after the surface, see index_of.
+        # @param _aperture the semi diameter. Rays that hit the surface
+        # farther from the axis are lost.
+        # @param _x the vertex position. Set by System.
+        self.R = _R
+        self.thickness = _thickness
+        self.medium = _medium
+        self.aperture = _aperture
+        self.x = _x
+        self.circle = None if self.flat() else Circle(_x - _R, 0, abs(_R))
+
+    def flat(self):
+        return isinf(self.R)
+
+    def sag(self, _h):
+        ## Returns how far past the vertex the surface is at height _h.
+        # Heights beyond the radius are clamped to it.
+        if self.flat():
+            return 0.
+        h = min(abs(_h), abs(self.R))
+        return self.R - np.sign(self.R) * sqrt(self.R * self.R - h * h)
+
+    def at(self, _x):
+        ## Returns a copy of the surface with its vertex at _x.
+        return Surface(self.R, self.thickness, self.medium, self.aperture, _x)
+
+    def intersect(self, _rays):
+        ## Returns where every ray of a RayBatch hits the surface.
+        # Rays that miss it or land outside the aperture are nan.
+        if self.flat():
+            t = (self.x - _rays.origins[:, 0]) / np.where(_rays.directions[:, 0] == 0, np.nan, _rays.directions[:, 0])
+            points = _rays.origins + t[:, None] * _rays.directions
+        else:
+            # the intersection on the same side of the center as the vertex.
+            points = Utils.findIntersectionBatch(self.circle, _rays, 0 if self.R > 0 else 1)
+
+        if not isinf(self.aperture):
+            outside = np.sum(points[:, 1:] * points[:, 1:], axis=1) > self.aperture ** 2
+            points[outside] = np.nan
+        return points
+
+    def normals(self, _points):
+        ## Returns the normal lines at points on the surface as a RayBatch.
+        if self.flat():
+            directions = np.zeros_like(_points)
+            directions[:, 0] = 1
+            return RayBatch(_points, directions)
+        return self.circle.getNormalBatch(_points)
+
+    def refract(self, _rays, _n1, _n2):
+        ## The kernel for one surface. Returns the refracted RayBatch with
+        # its origins on the surface, see Utils.snellsBatch.
+        # @param _n1 the index before the surface.
+        # @param _n2 the index after the surface.
+        return Utils.snellsBatch(_rays, self.normals(self.intersect(_rays)), _n1, _n2)
+
+## An ordered list of surfaces from the source to the sensor.
+class System:
+    def __init__(self, _surfaces, _OD=None):
+        ## Constructer. Places the surfaces along the axis.
+        # @param _surfaces the Surfaces in order. The thickness of the last one
+        # is ignored, the sensor distance is given to the CameraModel.
+        # @param _OD the diameter the source fills. Defaults to twice the
+        # aperture of the first surface.
+        self.T = float(sum(surface.thickness for surface in _surfaces[:-1]))
+        self.surfaces = []
+        x = self.T / 2
+        for surface in _surfaces:
+            self.surfaces.append(surface.at(x))
+            x -= surface.thickness
+        self.aperture = self.surfaces[0].aperture
+        self.OD = 2 * self.aperture if _OD is None else _OD
+
+    def stop_radius(self):
+        ## Returns the radius of the stop, the front surface clipped to the OD.
+        return min(self.aperture, self.OD / 2)
+
+    def cone_angle(self, _D):
+        ## Returns the half angle of the cone from an on axis source _D in
+        # front of the first vertex whose edge rays land on the rim of the stop.
+        a = self.stop_radius()
+        # a hair inside so rounding doesn't clip the edge rays.
+        return atan(a * (1 - 1e-9) / (_D + self.surfaces[0].sag(a)))
+
+    def media(self):
+        ## Returns the media of the gaps, starting with the air before the first surface.
+        return [None] + [surface.medium for surface in self.surfaces]
+
+    def indices(self, _wavelengths=None):
+        ## Returns the index of every gap, see index_of.
+        return [index_of(medium, _wavelengths) for medium in self.media()]
+
+    def withCoverGlass(self, _gap, _thickness, _medium='N-BK7'):
+        ## Returns a copy of the system with a flat plate after the last surface.
+        # The sensor distance of a CameraModel is then measured from the back of the plate.
+        # @param _gap distance from the last vertex to the plate.
+        # @param _thickness the plate thickness.
+        # @param _medium the plate material, see index_of.
+        last = self.surfaces[-1]
+        surfaces = self.surfaces[:-1] + [Surface(last.R, _gap, last.medium, last.aperture),
+                                         Surface(inf, _thickness, _medium), Surface(inf, 0)]
+        return System(surfaces, self.OD)
+
+    def trace_batch(self, _rays, _wavelengths=None, _stats=None):
+        ## Traces a RayBatch through every surface.
+        # Rays that miss a surface or the aperture, or can't refract, come out
+        # as nan with their status set (see gimath RAY_STATUS).
+        # @param _rays the incoming RayBatch.
+        # @param _wavelengths optional per ray wavelengths in nm.
+        # @param _stats optional TraceStats that times every surface.
+        # @return the list of rays leaving each surface. Their origins are
+        # the hits, which gives the optical path through the system.
+        n = self.indices(_wavelengths)
+        out = []
+        rays = _rays
+        for i, surface in enumerate(self.surfaces):
+            with stage(_stats, 'surface {}'.format(i + 1)):
+                rays = surface.refract(rays, n[i], n[i + 1])
+            out.append(rays)
+        return out
+
+    def refract_batch(self, _rays, _wavelengths=None, _stats=None):
+        ## Traces a RayBatch through the system and returns the exit rays.
+        # See trace_batch.
+        return self.trace_batch(_rays, _wavelengths, _stats)[-1]
+
+    def refract(self, _ray):
+        ## Traces one scalar Ray. Returns the exit ray or None if it is lost.
+        out = self.refract_batch(RayBatch.fromRays([_ray]))
+        return out.getRay(0) if out.valid()[0] else None
+
+def doublet(_R1, _R2, _R3, _T1, _T2, _OD, _glass1='N-BK7', _glass2='N-SF11'):
+    ## Returns a cemented doublet, e.g. a crown element followed by a flint one.
+    # @param _R1, _R2, _R3 the signed radii of the three surfaces.
+    # @param _T1, _T2 the center thicknesses of the elements.
+    # @param _OD the aperture.
+    return System([Surface(_R1, _T1, _glass1, _OD / 2), Surface(_R2, _T2, _glass2), Surface(_R3, 0)], _OD)
@@ -3,7 +3,7 @@
 '''
 import pytest
 from gimath import Ray, EPSILON
-from math import pi, cos, sqrt
+from math import pi, cos, sqrt, tan, atan
 
 def soft_equal(arg1, arg2):
     return abs(arg1 - arg2) < EPSILON
@@ -149,6 +149,13 @@ def test_sensor():
                              [0., 0., 1., 0., 0.]])
     assert np.array_equal(test_output1, sensor2.sensor)
 
+    sensor5 = Sensor(4, 5)
+    assert sensor5.write_many([0, 2, -2, 2.5, np.nan]) == (3, 2)
+    assert np.array_equal(test_output1, sensor5.sensor)
+    assert sensor5.write_many([0, 0], _xs=[-2, 1.9], _weights=[.5, 2]) == (2, 0)
+    assert sensor5.sensor[2][0] == .5
+    assert sensor5.sensor[2][4] == 2
+
     test_output2 = np.array([ [0., 0., 1., 0., 0.],
                              [0., 0., 0., 0., 0.],
                              [1., 0., 1., 0., 1.],
@@ -158,13 +165,28 @@ def test_sensor():
     sensor2.rotate()
     assert np.array_equal(test_output2, sensor2.sensor)
 
-    # sensor.write(0)
-    # sensor.write(4)
-    # print(sensor.sensor)
-    # sensor.rotate()
-    # print()
-    # print(sensor.sensor)
-    # assert 0
+    # compare against rotating one pixel at a time.
+    sensor3 = Sensor(10, 51)
+    sensor3.sensor[:, 25] = np.arange(51)
+    expected = sensor3.sensor.copy()
+    for pixelX in range(51):
+        for pixelY in range(51):
+            xCentered = pixelX - 25
+            mag = sqrt(xCentered * xCentered + (25 - pixelY) ** 2)
+            if xCentered == 0 or mag > 25:
+                continue
+            side = -1 if xCentered < 0 else 1
+            expected[pixelY][pixelX] += sensor3.sensor[25 + side * int(mag)][25]
+    sensor3.rotate()
+    assert np.array_equal(expected, sensor3.sensor)
+
+    # bilinear only differs from truncation between pixel centers.
+    sensor4 = Sensor(4, 5)
+    sensor4.sensor[:, 2] = [1., 0., 3., 0., 1.]
+    sensor4.rotate(_bilinear=True)
+    assert sensor4.sensor[2][0] == 1
+    assert sensor4.sensor[2][4] == 1
+    assert soft_equal(sensor4.sensor[1][1], sqrt(2) - 1)
 
 from gicameramodel import Lens
 def test_lens():
@@ -185,3 +207,896 @@ def test_camera_model():
 
     camera = CameraModel(10, 10, 5, 5, 10, 5, 11, 50)
     camera.sample_point_source(100)
+
+
+from gimath import RayBatch
+
+def test_ray_batch():
+
+    circle = Circle(3, 1.23, 2.4)
+    rays = [Ray((0, -45), (1, 23)), Ray((0, 22.77), (1, 23)), Ray((4, 5), (-1, -1))]
+    batch = RayBatch.fromRays(rays)
+    assert len(batch) == 3
+    for index in range(2):
+        points = Utils.findIntersectionBatch(circle, batch, index)
+        for ray, point in zip(rays, points):
+            expected = Utils.findIntersection(circle, ray)
+            if expected is None:
+                assert np.all(np.isnan(point))
+            else:
+                assert soft_equal_tuple(point, expected[index])
+
+    ray = Ray((1 / 2, -sqrt(3) / 2), (-sqrt(3) / 2, 1 / 2))
+    normal = Ray((0, 0), (-1, 1))
+    out = Utils.snellsBatch(RayBatch.fromRays([ray]), RayBatch.fromRays([normal]), 1.2, 1)
+    assert soft_equal_tuple(out.directions[0], Utils.snells2(ray, normal, 1.2, 1).direction)
+
+    # total internal reflection comes back as nan.
+    ray = Ray((0, 0), (-1, 10))
+    normal = Ray((0, 0), (1, 0))
+    out = Utils.snellsBatch(RayBatch.fromRays([ray]), RayBatch.fromRays([normal]), 1.5, 1)
+    assert np.all(np.isnan(out.directions))
+
+def test_lens_batch():
+
+    lens = Lens(10, 10, 5, 5)
+    thetas = np.linspace(-.004, .004, num = 11)
+    rays = [Ray((502.5, 0), (-1, tan(theta))) for theta in thetas]
+    out = lens.refract_batch(RayBatch.fromRays(rays))
+    for i, ray in enumerate(rays):
+        expected = lens.refract(ray)
+        assert soft_equal_tuple(out.origins[i], expected.origin)
+        assert soft_equal_tuple(out.directions[i], expected.direction)
+        assert soft_equal(out.getY(-11.5)[i], expected.getY(-11.5))
+
+    # a 3D batch in the meridional plane matches the 2D one.
+    out3 = lens.refract_batch(RayBatch((502.5, 0, 0), [(-1, tan(theta), 0) for theta in thetas]))
+    assert np.allclose(out3.directions[:, :2], out.directions)
+    assert np.allclose(out3.directions[:, 2], 0)
+
+from gisampling import PupilGrid
+
+def test_pupil_grid():
+
+    for kind in PupilGrid.KINDS:
+        grid = PupilGrid(10000, kind)
+        points = np.concatenate(list(grid.chunks(777)))
+        assert abs(len(points) - 10000) < 300
+        assert np.all(np.sum(points * points, axis=1) <= 1)
+        # chunking doesn't change the points.
+        assert np.array_equal(points, grid.points(0, grid.size))
+
+    assert len(PupilGrid(1, 'polar').points(0, 1)) == 1
+
+def test_camera_model_pupil():
+
+    camera = CameraModel(10, 10, 5, 5, 10, 5, 21, 50)
+    camera.sample_pupil(5000, _chunk=100)
+    camera2 = CameraModel(10, 10, 5, 5, 10, 5, 21, 50)
+    camera2.sample_pupil(5000)
+    assert np.array_equal(camera.sensor.sensor, camera2.sensor.sensor)
+
+    # the square grid is symmetric so the psf is too, corners included.
+    sensor = camera.sensor.sensor
+    assert sensor.sum() > 0
+    assert np.array_equal(sensor, sensor.T)
+    assert np.array_equal(sensor, sensor[::-1, ::-1])
+
+import os
+import tempfile
+from gisweep import FocusSweep
+from gifield import FieldMap
+
+def test_focus_sweep(tmp_path, monkeypatch):
+
+    sweep = FocusSweep(10, 10, 5, 5, 5, 11, 100)
+    Ds = [50, 500]
+    D2s = [9, 10, 11]
+    stack = sweep.run(Ds, D2s, str(tmp_path / "stack.dat"), _workers=2)
+    assert stack.shape == (2, 3, 11, 11)
+
+    for i, D in enumerate(Ds):
+        for j, D2 in enumerate(D2s):
+            camera = CameraModel(10, 10, 5, 5, D2, 5, 11, D)
+            camera.sample_point_source(100)
+            assert np.array_equal(stack[i, j], camera.sensor.sensor)
+
+    serial = sweep.run(Ds, D2s, str(tmp_path / "serial.dat"), _workers=1)
+    assert np.array_equal(serial, stack)
+
+    # without a path the stack is mapped from a file that is already unlinked.
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path / "temp"))
+    os.makedirs(tempfile.tempdir)
+    for workers in (1, 2):
+        temporary = sweep.run(Ds, D2s, _workers=workers)
+        assert isinstance(temporary, np.memmap) and np.array_equal(temporary, stack)
+        fields, _ = FieldMap(10, 10, 5, 5, 9, 5, 11, 500, 50).run([(0, 0), (5, 0)], _workers=workers)
+        assert fields.shape == (2, 11, 11) and fields.sum() > 0
+    assert os.listdir(tempfile.tempdir) == []
+
+import gipool
+
+def test_pool():
+
+    # ordered maps keep the task order, serial runs clean up after themselves.
+    for workers in (1, 2):
+        assert list(gipool.pool_map(abs, range(-5, 0), workers, _ordered=True)) == [5, 4, 3, 2, 1]
+        assert sorted(gipool.pool_map(abs, range(-5, 0), workers)) == [1, 2, 3, 4, 5]
+    assert gipool.worker_state == {}
+    assert gipool.worker_count(None, 1) == 1 and gipool.worker_count(8, 3) == 3
+    assert gipool.chunk_size(100, 2) == 12 and gipool.chunk_size(3, 4) == 1
+
+import gicache
+from gicache import PSFCache
+
+def test_psf_cache(tmp_path, monkeypatch):
+
+    params = (10, 10, 5, 5, 10, 5, 11, 50, 100)
+    camera = CameraModel(*params[:-1])
+    camera.sample_point_source(100)
+
+    cache = PSFCache(_path=str(tmp_path))
+    psf = cache.get(*params)
+    assert np.array_equal(psf, camera.sensor.sensor)
+    assert cache.get(*params) is psf
+    assert cache.stats.misses == 1 and cache.stats.memory_hits == 1
+
+    # a new cache finds it on disk.
+    cache2 = PSFCache(_path=str(tmp_path))
+    assert np.array_equal(cache2.get(10., 10, 5, 5, 10, 5, 11, 50, 100), psf)
+    assert cache2.stats.disk_hits == 1 and cache2.stats.misses == 0
+
+    # room for a single 11 x 11 psf in memory.
+    cache3 = PSFCache(_max_bytes=11 * 11 * 8)
+    cache3.get(*params)
+    cache3.get(10, 10, 5, 5, 10, 5, 11, 60, 100)
+    cache3.get(*params)
+    assert cache3.stats.misses == 3 and cache3.stats.memory_evictions == 2
+
+    # the glass and the cache version are part of the key.
+    key = PSFCache.key(*params)
+    assert PSFCache.key(*params, 'N-BK7') != key
+    assert PSFCache.key(*params, 'N-BK7') != PSFCache.key(*params, 'N-SF11')
+    gicache.CACHE_VERSION += 1
+    try:
+        assert PSFCache.key(*params) != key
+    finally:
+        gicache.CACHE_VERSION -= 1
+    flint = cache.get(*params, 'N-SF11')
+    assert cache.stats.misses == 2 and not np.array_equal(flint, psf)
+
+    # other processes may evict files at any point.
+    racy = PSFCache(_path=str(tmp_path / "racy"), _max_disk_bytes=1)
+    store = racy.store
+    def store_then_evict(_key, _psf):
+        store(_key, _psf)
+        os.remove(racy.file(_key))
+    racy.store = store_then_evict
+    assert np.array_equal(racy.get(*params), psf)
+    assert racy.load(PSFCache.key(*params)) is None
+    del racy.store
+
+    remove = os.remove
+    def remove_twice(_name):
+        remove(_name)
+        remove(_name)
+    monkeypatch.setattr(os, 'remove', remove_twice)
+    racy.get(10, 10, 5, 5, 10, 5, 11, 60, 100)
+    racy.get(10, 10, 5, 5, 10, 5, 11, 70, 100)
+    monkeypatch.undo()
+    assert sorted(os.listdir(tmp_path / "racy")) == [PSFCache.key(10, 10, 5, 5, 10, 5, 11, 70, 100) + ".npy"]
+
+from giglass import GLASSES, D_LINE
+
+def test_polychromatic():
+
+    assert abs(GLASSES['N-BK7'].index(D_LINE) - 1.5168) < EPSILON
+    assert GLASSES['N-BK7'].index(450) > GLASSES['N-BK7'].index(650)
+    assert abs(GLASSES['BK7 cauchy'].index(D_LINE) - 1.5168) < .001
+    assert Lens(10, 10, 5, 5).index([500, 600]).tolist() == [1.5168, 1.5168]
+
+    # one wavelength matches a plain trace with that index.
+    camera = CameraModel(10, 10, 5, 5, 9, 5, 21, 500, 'N-BK7')
+    psfs, total = camera.sample_spectrum(100, [450, 650])
+    assert psfs.shape == (2, 21, 21)
+    assert np.array_equal(camera.sensor.sensor, total)
+    for psf, wavelength in zip(psfs, [450, 650]):
+        plain = CameraModel(10, 10, 5, 5, 9, 5, 21, 500)
+        plain.lens.n_glass = float(GLASSES['N-BK7'].index(wavelength))
+        plain.sample_point_source(100)
+        assert np.array_equal(psf, plain.sensor.sensor)
+
+    # the 2D grid keeps every ray on the sensor.
+    camera = CameraModel(10, 10, 5, 2, 9, 5, 21, 500, 'N-SF11')
+    psfs, total = camera.sample_spectrum(2000, np.linspace(400, 700, 31), _grid='hex', _chunk=999)
+    assert psfs.shape == (31, 21, 21)
+    assert np.allclose(psfs.sum(axis=(1, 2)), psfs[0].sum())
+    assert abs(total.sum() - psfs[0].sum()) < EPSILON
+
+import sys
+import json
+import gibench
+
+def test_bench(tmp_path, monkeypatch):
+
+    assert gibench.read_args() == {'R1': 10, 'R2': 10, 'T': 5, 'OD': 5, 'D2': 9,
+                                   'h': 10, 'M': 1025, 'D': 500, 'N': 400}
+
+    args = dict(gibench.read_args(), M=11, N=50)
+    history = str(tmp_path / "history.json")
+    results = gibench.run([gibench.camera_case("small", args)], 1, history)
+    gibench.run([gibench.camera_case("small", args)], 1, history)
+    assert len(json.load(open(history))) == 2
+    assert results['small']['rays_per_sec'] > 0
+    assert results['small']['peak_bytes'] > 0
+
+    slower = {'small': dict(results['small'], seconds=results['small']['seconds'] * 2)}
+    assert gibench.compare(results, slower, .25) == []
+    assert [r[:2] for r in gibench.compare(slower, results, .25)] == [('small', 'seconds')]
+
+    # peak memory is a regression too, under its own tolerance if given.
+    bigger = {'small': dict(results['small'], peak_bytes=results['small']['peak_bytes'] * 2)}
+    assert [r[:2] for r in gibench.compare(bigger, results, .25)] == [('small', 'peak_bytes')]
+    assert gibench.compare(bigger, results, .25, 1.5) == []
+
+    # updating a baseline needs to know which one, before anything runs.
+    monkeypatch.setattr(sys, 'argv', ['gibench.py', '--update-baseline'])
+    with pytest.raises(SystemExit) as exit:
+        gibench.main()
+    assert exit.value.code == 2
+
+def test_trace_stats():
+
+    camera = CameraModel(10, 10, 5, 5, 9, 5, 21, 500, 'N-SF11')
+    assert camera.stats is None
+    stages = []
+    stats = camera.enable_stats(lambda name, seconds: stages.append(name))
+    camera.sample_point_source(1000)
+    camera.sample_pupil(1000, _chunk=100)
+
+    counts = stats.counts
+    assert counts['rays'] == 1000 + sum(len(p) for p in PupilGrid(1000).chunks(100))
+    # the launch cone fills the stop and no more.
+    assert counts['lens_misses'] == 0
+    assert camera.lens_miss == counts['lens_misses']
+    lost = counts['lens_misses'] + counts['tir'] + counts['tangent']
+    assert counts['rays'] == lost + counts['sensor_hits'] + counts['sensor_misses']
+    assert set(stages) == set(stats.STAGES)
+    assert stats.calls['rotate'] == 1
+    assert 'surface 1' in stats.report()
+
+from gimath import RAY_OK, RAY_MISSED, RAY_TIR, RAY_TANGENT
+
+def test_ray_failures():
+
+    # a wide aperture lets the marginal rays totally internally reflect.
+    lens = Lens(10, 10, 5, 19.9, 'N-SF11')
+    assert soft_equal(lens.aperture, sqrt(100 - 7.5 ** 2))
+    slopes = np.linspace(-.03, .03, 61)
+    rays = RayBatch((502.5, 0), np.column_stack((-np.ones(61), slopes)))
+    out = lens.refract_batch(rays)
+    counts = out.statusCounts()
+    assert counts[RAY_OK] > 0 and counts[RAY_TIR] > 0 and counts[RAY_MISSED] > 0
+    assert np.all(np.isnan(out.directions[~out.valid()]))
+    assert not np.any(np.isnan(out.directions[out.valid()]))
+
+    # the scalar path agrees ray by ray instead of crashing.
+    for i, slope in enumerate(slopes):
+        ray_out = lens.refract(Ray((502.5, 0), (-1, slope)))
+        assert (ray_out is None) == (out.status[i] != RAY_OK)
+
+    # the aperture stop uses OD.
+    narrow = Lens(10, 10, 5, 2).refract_batch(rays)
+    assert narrow.statusCounts()[RAY_OK] < counts[RAY_OK]
+    assert np.all(np.abs(narrow.origins[narrow.valid(), 1]) < 2)
+
+    # grazing rays are tangent rather than fatal.
+    ray = Ray((0, 0), (0, 1))
+    normal = Ray((0, 0), (1, 0))
+    assert Utils.snells2(ray, normal, 1, 1.5) is None
+    out = Utils.snellsBatch(RayBatch.fromRays([ray]), RayBatch.fromRays([normal]), 1, 1.5)
+    assert out.status[0] == RAY_TANGENT
+    assert Utils.snells(pi / 2, 1.5, 1) is None
+
+    camera = CameraModel(10, 10, 5, 19.9, 9, 5, 21, 500, 'N-SF11')
+    camera.sample_point_source(500)
+    assert camera.tir > 0 and camera.lens_miss == 0
+    camera.sample_ray(.03)
+
+    # the launch cone is sized from the stop, so nothing is lost at it.
+    for D in (500, 20, float('inf')):
+        camera = CameraModel(10, 10, 5, 5, 9, 10, 101, D)
+        camera.sample_point_source(400)
+        camera.sample_pupil(4000)
+        assert camera.lens_miss == 0
+        edge = camera.lens.refract_batch(RayBatch(*camera.launch_fan(np.array([1.])))).status[0]
+        assert edge == RAY_OK
+        assert camera.lens.refract_batch(RayBatch(*camera.launch_fan(np.array([1.001])))).status[0] == RAY_MISSED
+
+from giparaxial import Paraxial, autofocus, spot, pupil_rays, rms_spot
+
+def test_paraxial():
+
+    lens = Lens(10, 12, 5, 4)
+    n = lens.n_glass
+    paraxial = Paraxial(lens)
+
+    # the thick lens maker's equation.
+    power = (n - 1) * (1 / 10 + 1 / 12 - (n - 1) * 5 / (n * 10 * 12))
+    assert soft_equal(paraxial.focal_length(), 1 / power)
+    assert soft_equal(paraxial.back_focal_distance(),
+                      paraxial.focal_length() * (1 - (n - 1) * 5 / (n * 10)))
+    assert soft_equal(paraxial.image_distance(float('inf')), paraxial.back_focal_distance())
+    assert paraxial.image_distance(100) > paraxial.image_distance(1000)
+
+    # a narrow pencil focuses at the paraxial image.
+    narrow = Lens(10, 12, 5, .2)
+    assert abs(autofocus(narrow, 500)[0] - Paraxial(narrow).image_distance(500)) < .01
+
+    # spherical aberration pulls the best focus in, and it beats its neighbours.
+    D2, rms = autofocus(lens, 500)
+    assert D2 < paraxial.image_distance(500)
+    heights, slopes = spot(lens, pupil_rays(lens, 500, 4000))
+    assert rms < rms_spot(heights, slopes, D2 - .05)
+    assert rms < rms_spot(heights, slopes, D2 + .05)
+
+    D2, rms = autofocus(lens, float('inf'))
+    assert D2 < paraxial.back_focal_distance()
+
+import gimetrics
+
+def test_metrics():
+
+    points = np.array([[0, 0], [1, 0], [0, 1], [-1, 0], [0, -1], [np.nan, 0]])
+    assert np.array_equal(gimetrics.centroid(points), [0, 0])
+    assert soft_equal(gimetrics.rms_radius(points), sqrt(4 / 5))
+    assert soft_equal(gimetrics.rms_radius(points, [4, 1, 1, 1, 1, 1]), sqrt(4 / 8))
+    assert np.allclose(gimetrics.encircled_energy(points, [0, .5, 1, 2]), [.2, .2, 1, 1])
+    corner = [[0, 0], [.9, .9]]
+    assert np.allclose(gimetrics.encircled_energy(corner, [1], _center=[0, 0]), [.5])
+    assert np.allclose(gimetrics.ensquared_energy(corner, [.5, 1], _center=[0, 0]), [.5, 1])
+    assert np.allclose(gimetrics.encircled_energy([1, 2, 3], [0, 1], _center=[2]), [1 / 3, 1])
+
+    # two lines 1 mm apart have zero contrast at .5 cycles / mm.
+    assert np.allclose(gimetrics.mtf([[0, 0], [1, 0]], [0, .5, 1]), [1, 0, 1])
+
+    # the spot gets smaller towards focus.
+    camera = CameraModel(10, 10, 5, 2, 12, 5, 21, 500)
+    focused = CameraModel(10, 10, 5, 2, 9, 5, 21, 500)
+    assert gimetrics.rms_radius(focused.sensor_points(2000)) < gimetrics.rms_radius(camera.sensor_points(2000))
+    assert np.allclose(gimetrics.centroid(camera.sensor_points(2000)), 0)
+
+from gitransfer import TransferTable
+
+def test_transfer_table():
+
+    lens = Lens(10, 10, 5, 5)
+    table = TransferTable(lens, _max_slope=.1)
+    assert table.height_error < EPSILON
+    assert table.slope_error < EPSILON
+
+    for D in (50, 500, float('inf')):
+        camera = CameraModel(10, 10, 5, 5, 9, 5, 11, D)
+        heights = table.sensor_heights(D, 9, 101)
+        # the table fires the same fan as the camera.
+        origins, directions = camera.launch_fan(np.linspace(-1, 1, 101))
+        origins = np.broadcast_to(origins, directions.shape)
+        heights_in, slopes = table.fan(D, 101)
+        front = RayBatch(origins, directions).pointsAt(5 / 2)[:, 1]
+        assert np.allclose(heights_in, front) and np.allclose(slopes, directions[:, 1] / -directions[:, 0])
+        hits = camera.trace(*camera.launch_fan(np.linspace(-1, 1, 101)))
+        assert not np.any(np.isnan(hits[:, 1]))
+        assert np.array_equal(np.isnan(heights), np.isnan(hits[:, 1]))
+        assert np.nanmax(np.abs(heights - hits[:, 1])) < 10 * EPSILON
+
+        camera.sample_point_source(101)
+        assert abs(table.psf(D, 9, 5, 11, 101) - camera.sensor.sensor).sum() <= 4
+
+    # slopes past the table are traced exactly.
+    out_h, out_s = table.lookup(np.array([0., 1.]), np.array([0., .5]))
+    assert not np.isnan(out_h[1])
+
+import sys
+import zlib
+import gibatch
+
+def test_batch(tmp_path):
+
+    # nothing imports plotly unless asked to.
+    import giapp
+    assert 'plotly' not in sys.modules
+
+    (tmp_path / "params.jsonl").write_text(
+        '{"R1": 10, "R2": 10, "T": 5, "OD": 5, "D2": 9, "h": 5, "M": 11, "D": 50, "N": 100}\n'
+        '{"R1": 10, "R2": 10, "T": 5, "OD": 5, "D2": 9, "h": 5, "M": 11, "D": 500, "N": 100, "name": "far"}\n')
+    (tmp_path / "params.csv").write_text("R1,R2,T,OD,D2,h,M,D,N,grid\n10,10,5,5,9,5,11,50,100,hex\n")
+    (tmp_path / "args.txt").write_text("--R1 10 --R2 10 --T 5 --OD 5 --D2 9 --h 5 --M 11 --D 50 --N 100\n")
+
+    params = gibatch.read_params(str(tmp_path / "params.jsonl"))
+    assert [p['name'] for p in params] == ['psf_00000', 'far']
+    assert gibatch.read_params(str(tmp_path / "args.txt"))[0] == params[0]
+    assert gibatch.read_params(str(tmp_path / "params.csv"))[0]['grid'] == 'hex'
+
+    camera = CameraModel(10, 10, 5, 5, 9, 5, 11, 50)
+    camera.sample_point_source(100)
+
+    results = gibatch.run(params, str(tmp_path / "out"), 'npy', _workers=2)
+    assert np.array_equal(np.load(results[0][0]), camera.sensor.sensor)
+    assert json.load(open(str(tmp_path / "out" / "far.json")))['D'] == 500
+
+    path, metadata = gibatch.run(params[:1], str(tmp_path / "out"), 'npz', _workers=1)[0]
+    assert np.array_equal(np.load(path)['psf'], camera.sensor.sensor)
+    assert json.loads(str(np.load(path)['metadata']))['N'] == 100
+
+    path, metadata = gibatch.run(params[:1], str(tmp_path / "out"), 'png', _workers=1)[0]
+    data = open(path, 'rb').read()
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    assert data[12:16] == b'IHDR' and data[24] == 16
+    idat = data.index(b'IDAT')
+    length = int.from_bytes(data[idat - 4:idat], 'big')
+    rows = np.frombuffer(zlib.decompress(data[idat + 4:idat + 4 + length]), np.uint8).reshape(11, 23)
+    pixels = rows[:, 1:].copy().view('>u2')
+    expected = np.round(camera.sensor.sensor / camera.sensor.sensor.max() * 65535)
+    assert np.array_equal(pixels, expected)
+
+from gipsf import RadialPSF
+
+def test_radial_psf():
+
+    camera = CameraModel(10, 10, 5, 5, 9, 5, 101, 50)
+    camera.sample_point_source(400)
+    radial = CameraModel(10, 10, 5, 5, 9, 5, 101, 50).sample_radial(400)
+    assert radial.nbytes() == 101 * 4
+    assert np.array_equal(radial.image(), camera.sensor.sensor)
+    assert radial.image() is radial.image()
+    assert radial.image().dtype == np.float32
+
+    exact = CameraModel(10, 10, 5, 5, 9, 5, 101, 50).sample_radial(400, _dtype=np.float64)
+    assert exact.image().dtype == np.float64
+
+    sensor = Sensor(4, 5)
+    sensor.write_many([0, 2, -2])
+    psf = RadialPSF.fromSensor(sensor, _bilinear=True, _dtype=np.float64)
+    sensor.rotate(_bilinear=True)
+    assert np.array_equal(psf.expand(), sensor.sensor)
+
+    # the cache of expansions stays bounded.
+    psfs = [RadialPSF(np.arange(5), 4) for _ in range(RadialPSF.max_expanded + 5)]
+    for p in psfs:
+        p.image()
+    assert len(RadialPSF.expanded) == RadialPSF.max_expanded
+    psfs[-1].release()
+    assert psfs[-1] not in RadialPSF.expanded
+
+from gisampling import stratified, stratifiedDisc
+
+def test_progressive():
+
+    rng = np.random.default_rng(0)
+    samples = stratified(100, rng)
+    assert np.array_equal(np.floor((samples + 1) * 50), np.arange(100))
+    assert np.all(np.sum(stratifiedDisc(1000, rng) ** 2, axis=1) <= 1)
+
+    camera = CameraModel(10, 10, 5, 2, 9, 5, 51, 500)
+    progress = camera.sample_progressive(_tolerance=1e-2, _batch=2000)
+    assert progress.converged
+    assert progress.changes[-1] < 1e-2 and progress.changes[-2] < 1e-2
+    assert camera.sensor.sensor[:, 25].sum() + camera.lens_miss == progress.rays
+
+    # converges to the same psf as a big one shot run.
+    reference = CameraModel(10, 10, 5, 2, 9, 5, 51, 500)
+    reference.sample_point_source(200000)
+    psf = camera.sensor.sensor / camera.sensor.sensor.sum()
+    assert np.abs(psf - reference.sensor.sensor / reference.sensor.sensor.sum()).sum() < .1
+
+    # budgets stop it early.
+    camera = CameraModel(10, 10, 5, 2, 9, 5, 51, 500)
+    progress = camera.sample_progressive(_tolerance=0, _batch=1000, _max_rays=5000, _grid=True)
+    assert not progress.converged and progress.batches() == 5
+    progress = camera.sample_progressive(_tolerance=0, _batch=1000, _time_budget=0)
+    assert progress.batches() == 1
+
+from gisampling import adaptiveAngles
+
+def test_adaptive():
+
+    sensor = Sensor(4, 5)
+    sensor.write_segments([.4, 1.2, -2], [-.4, 1.2, 3], [1, 2, 5])
+    assert np.allclose(sensor.sensor[:, 2], [.8, 2.8, 1.8, .8, .8])
+
+    # a fold at 0 and a jump at .5 get refined, the flat parts don't.
+    angles, heights = adaptiveAngles(lambda t: np.where(t < .5, t * t, 1), -1, 1, 21, .05, 1000)
+    assert np.all(np.diff(angles) > 0)
+    spacing = np.diff(angles)
+    assert spacing[np.searchsorted(angles, .5) - 1] < .01
+    assert spacing[np.searchsorted(angles, 0) - 1] < .1
+    assert soft_equal(spacing[-1], .1)
+    assert len(adaptiveAngles(lambda t: t * 100, -1, 1, 21, .05, 50)[0]) == 50
+
+    # an order of magnitude fewer rays than the uniform fan does better.
+    reference = CameraModel(10, 10, 5, 5, 9, 3, 101, 500)
+    reference.sample_point_source(1000000)
+    reference = reference.sensor.sensor / reference.sensor.sensor.sum()
+    uniform = CameraModel(10, 10, 5, 5, 9, 3, 101, 500)
+    uniform.sample_point_source(10000)
+    adaptive = CameraModel(10, 10, 5, 5, 9, 3, 101, 500)
+    assert adaptive.sample_adaptive(250, 1000) <= 1000
+    error = lambda camera: np.abs(camera.sensor.sensor / camera.sensor.sensor.sum() - reference).sum()
+    assert error(adaptive) < error(uniform)
+
+from gifield import FieldMap, field_grid, field_from_angles
+
+def test_field_map(tmp_path):
+
+    # on axis the PSF is symmetric and centered.
+    field = FieldMap(10, 10, 5, 5, 9, 1, 21, 500, 2000)
+    psf, chief = field.psf((0, 0))
+    assert np.allclose(chief, 0)
+    assert np.allclose(psf, psf[::-1, :]) and np.allclose(psf, psf.T)
+    assert psf[10, 10] == psf.max()
+
+    fields = field_grid(20, 3)
+    assert fields.shape == (9, 2)
+    psfs, chiefs = field.run(fields, str(tmp_path / "field.dat"), _workers=2)
+    assert psfs.shape == (9, 21, 21)
+
+    # the image is inverted and symmetric about the axis.
+    assert np.all(chiefs[fields[:, 0] > 0, 0] < 0)
+    assert np.allclose(chiefs[0], -chiefs[-1])
+    assert np.allclose(psfs[0], psfs[-1][::-1, ::-1])
+    assert psfs[4].sum() > 0 and psfs[0].sum() > 0
+
+    serial, serial_chiefs = field.run(fields, str(tmp_path / "serial.dat"), _workers=1)
+    assert np.array_equal(serial, psfs) and np.array_equal(serial_chiefs, chiefs)
+
+    # a collimated beam at a small angle lands near f * tan(angle).
+    from giparaxial import Paraxial
+    angle = field_from_angles([.01, 0], float('inf'))
+    assert np.allclose(angle, [tan(.01), 0])
+    camera = CameraModel(10, 10, 5, 1, Paraxial(Lens(10, 10, 5, 1)).back_focal_distance(), 1, 21, float('inf'))
+    chief = camera.sample_field(1000, angle)
+    assert abs(chief[0] + Paraxial(camera.lens).focal_length() * tan(.01)) < .01
+
+from giimage import TiledConvolver, convolve, fast_length
+
+def test_image_formation(tmp_path):
+    assert fast_length(7) == 8 and fast_length(11) == 12 and fast_length(97) == 100
+
+    rng = np.random.default_rng(3)
+    image = rng.random((70, 90))
+    psf = rng.random((7, 6))
+
+    # brute force 'same' convolution about the PSF center.
+    expected = np.zeros_like(image)
+    cy, cx = 3, 3
+    for i in range(7):
+        for j in range(6):
+            shifted = np.zeros_like(image)
+            dy, dx = i - cy, j - cx
+            shifted[max(dy, 0):70 + min(dy, 0), max(dx, 0):90 + min(dx, 0)] = \
+                image[max(-dy, 0):70 - max(dy, 0), max(-dx, 0):90 - max(dx, 0)]
+            expected += psf[i, j] * shifted
+    expected /= psf.sum()
+
+    convolver = TiledConvolver(psf, _tile=16)
+    assert convolver.tile == 16 and convolver.bands(image) == 5
+    assert np.allclose(convolver.convolve(image), expected)
+
+    # streamed from and to disk over several processes.
+    np.save(str(tmp_path / "scene.npy"), image)
+    out = convolve(str(tmp_path / "scene.npy"), psf, str(tmp_path / "out.npy"), _tile=16, _workers=2)
+    assert np.allclose(out, expected)
+    assert np.allclose(np.load(str(tmp_path / "out.npy")), expected)
+
+    # a delta PSF leaves the scene alone, a tile smaller than the PSF is raised.
+    delta = np.zeros((9, 9))
+    delta[4, 4] = 1
+    assert TiledConvolver(delta, _tile=4).tile == 9
+    assert np.allclose(convolve(image, delta, _tile=4), image)
+
+    with pytest.raises(ValueError):
+        convolve(np.zeros(5), delta)
+
+import giwave
+
+def test_diffraction():
+    from giparaxial import Paraxial
+    lens = Lens(50, 50, 2, 1)
+    f = Paraxial(lens).focal_length()
+    bfd = Paraxial(lens).back_focal_distance()
+
+    # in focus a small aperture gives an Airy disc, 84% inside the first dark ring.
+    camera = CameraModel(50, 50, 2, 1, bfd, .4, 81, float('inf'))
+    camera.sample_diffraction()
+    psf = camera.sensor.sensor
+    y, x = (np.indices(psf.shape) - 40) * .4 / 81
+    r = np.hypot(x, y)
+    assert psf[40, 40] == psf.max()
+    assert np.allclose(psf, psf.T) and np.allclose(psf, psf[::-1])
+    assert abs(psf[r <= 1.22 * 587.56e-6 * f].sum() - .838) < .02
+
+    # longer wavelengths blur more.
+    red = giwave.diffraction_psf(camera, 700)
+    blue = giwave.diffraction_psf(camera, 450)
+    assert (red * r * r).sum() > (blue * r * r).sum()
+
+    # far from focus it agrees with the ray trace.
+    for D in (float('inf'), 300):
+        camera = CameraModel(50, 50, 2, 4, 52, .6, 121, D)
+        wave = giwave.diffraction_psf(camera)
+        camera.sample_pupil(100000)
+        rays = camera.sensor.sensor / camera.sensor.sensor.sum()
+        y, x = (np.indices(wave.shape) - 60) * .6 / 121
+        r2 = x * x + y * y
+        assert abs(sqrt((wave * r2).sum() / wave.sum()) / sqrt((rays * r2).sum()) - 1) < .25
+
+    # the plan is reused.
+    giwave.plans.clear()
+    camera = CameraModel(50, 50, 2, 1, bfd, .4, 81, float('inf'))
+    first = giwave.diffraction_psf(camera)
+    assert len(giwave.plans) == 1
+    assert np.array_equal(giwave.diffraction_psf(camera), first)
+    assert len(giwave.plans) == 1
+
+    # the caches are bounded and a focus sweep shares its pupil grids.
+    giwave.grids.clear()
+    for D2 in np.linspace(bfd - 1, bfd + 1, 8):
+        giwave.diffraction_psf(CameraModel(50, 50, 2, 1, D2, .4, 81, float('inf')))
+    assert len(giwave.grids) == 1 and len(giwave.plans) <= giwave.max_plans
+    assert np.allclose(giwave.pupil_grid(5, .5), np.hypot(*(np.indices((5, 5)) - 2.)) * .5)
+    assert np.array_equal(giwave.pupil_grid(3, 2.), 2 * giwave.pupil_grid(3, 1.))
+
+    # oversampled plans still center the axis on the middle pixel.
+    giwave.plans.clear()
+    camera = CameraModel(50, 50, 2, 4, 52, .4, 81, float('inf'))
+    psf = giwave.diffraction_psf(camera)
+    (n_fft, s, dx), = giwave.plans.values()
+    assert s > 1 and n_fft % s == 0
+    assert np.allclose(psf, psf[::-1, ::-1]) and np.allclose(psf, psf.T)
+
+    assert giwave.center_crop(np.arange(16.).reshape(4, 4), 3).tolist() == [[5, 6, 7], [9, 10, 11], [13, 14, 15]]
+
+from gisystem import System, Surface, doublet, index_of
+
+def test_system():
+    from giparaxial import Paraxial, autofocus
+    assert index_of(None) == 1 and index_of(1.6, [500, 600]).tolist() == [1.6, 1.6]
+    assert abs(index_of('N-BK7') - 1.5168) < EPSILON
+
+    # the lens is the two surface preset. Splitting it with a flat surface
+    # inside the glass changes nothing.
+    lens = Lens(10, 10, 5, 5)
+    assert [surface.x for surface in lens.surfaces] == [2.5, -2.5]
+    split = System([Surface(10, 2.5, 1.5168, lens.aperture), Surface(float("inf"), 2.5, 1.5168), Surface(-10, 0)])
+    assert split.T == 5 and split.OD == 2 * lens.aperture
+    rays = RayBatch((500, 0, 0), np.column_stack((-np.ones(50), np.linspace(-.005, .005, 50), np.linspace(0, .004, 50))))
+    assert np.allclose(split.refract_batch(rays).pointsAt(-20), lens.refract_batch(rays).pointsAt(-20), equal_nan=True)
+    assert len(split.trace_batch(rays)) == 3
+    assert abs(Paraxial(split).focal_length() - Paraxial(lens).focal_length()) < EPSILON
+
+    # the scalar path agrees with Lens.refract.
+    ray = Ray((500, 0), (-1, .004))
+    expected = lens.refract(ray)
+    assert np.allclose(split.refract(ray).direction, expected.direction)
+    assert split.refract(Ray((500, 0), (-1, .1))) is None
+
+    # a plate of thickness t moves the focus out by about t (n - 1) / n.
+    system = System(lens.surfaces)
+    plate = system.withCoverGlass(5, 1, 1.5)
+    assert plate.T == 11 and len(plate.surfaces) == 4
+    D2, _ = autofocus(system, float('inf'), 2000)
+    D2_plate, _ = autofocus(plate, float('inf'), 2000)
+    assert abs(D2_plate + 1 + 5 - D2 - 1 / 3) < .02
+    assert abs(Paraxial(plate).back_focal_distance() + 6 - Paraxial(system).back_focal_distance() - 1 / 3) < EPSILON
+
+    # a doublet in a camera, every surface is a stage.
+    lens = doublet(20, -15, -60, 3, 1.5, 6)
+    assert [surface.medium for surface in lens.surfaces] == ['N-BK7', 'N-SF11', None]
+    camera = CameraModel.fromSystem(lens, Paraxial(lens).back_focal_distance(), .5, 51, float('inf'))
+    stats = camera.enable_stats()
+    camera.sample_pupil(5000)
+    assert camera.sensor.sensor.sum() > 4500
+    assert stats.calls['surface 3'] == stats.calls['surface 1']
+    assert camera.sensor.sensor[25, 25] == camera.sensor.sensor.max()
+
+from giopt import LensOptimizer, Dual, edge_thickness
+
+def test_optimizer():
+    from giparaxial import autofocus
+    x = Dual.variable(3., 0, 2)
+    y = Dual.variable(4., 1, 2)
+    r = (x * x + y * y).sqrt() / 2 - 1
+    assert r.value == 1.5 and np.allclose(r.grad, [.3, .4])
+
+    # the Dual trace matches Lens.refract_batch and its gradient matches
+    # finite differences.
+    opt = LensOptimizer(5, [500, float('inf')], 32)
+    p = np.array([10., 10, 5, 9])
+    heights = opt.heights
+    rays = RayBatch((502.5, 0), np.column_stack((-500 * np.ones(32), heights)))
+    expected = Lens(10, 10, 5, 5).refract_batch(rays).pointsAt(-11.5)[:, 1]
+    assert np.allclose(opt.spot(p, 500).value, expected)
+
+    f, g = opt.objective(p)
+    for i in range(4):
+        e = np.zeros(4)
+        e[i] = 1e-6 * p[i]
+        fd = (opt.objective(p + e)[0] - opt.objective(p - e)[0]) / (2 * e[i])
+        assert abs(fd - g[i]) < 1e-6 * abs(g[i]) + 1e-9
+
+    # only D2 free is an autofocus.
+    design = LensOptimizer(5, [float('inf')], 256, _free=('D2',)).optimize(p)
+    assert design.params['R1'] == 10 and design.params['T'] == 5
+    assert abs(design.params['D2'] - autofocus(Lens(10, 10, 5, 5), float('inf'), 20000)[0]) < .05
+
+    # everything free does better than the start and stays feasible.
+    design = opt.optimize(p)
+    assert design.rms < sqrt(f) / 2
+    assert opt.feasible(list(design.params.values()))
+    assert edge_thickness(*list(design.params.values())[:3], 5) >= 0
+    assert design.converged and design.reason == 'tolerance'
+
+    # a line search that finds no acceptable step is not a convergence.
+    stuck = LensOptimizer(5, [500, float('inf')], 32)
+    stuck.feasible = lambda _params: np.array_equal(_params, p)
+    design = stuck.optimize(p)
+    assert not design.converged and design.reason == 'line search'
+    assert design.params == dict(R1=10, R2=10, T=5, D2=9) and design.rms == sqrt(f)
+
+    assert not opt.feasible((10, 10, .5, 9))
+    assert not opt.feasible((2, 10, 5, 9))
+    with pytest.raises(ValueError):
+        opt.optimize((10, 10, .5, 9))
+
+    values = opt.evaluate_many([p, (10, 10, .5, 9), (12, 12, 5, 9)], 2)
+    assert values[0] == f and np.isnan(values[1]) and values[2] > 0
+    designs = opt.optimize_many([p, (20, 15, 4, 12)], 2)
+    assert designs[0].rms <= designs[1].rms
+
+    # T and D2 stay in their bounds instead of running the sensor onto the lens.
+    design = LensOptimizer(5, [300, 1000, float('inf')]).optimize((20, 15, 4, 12))
+    assert design.converged and 5 <= design.params['D2'] <= 100 and design.params['T'] <= 10
+    bounded = LensOptimizer(5, [500, float('inf')], 32, _T_range=(2, 6), _D2_range=(8, 12))
+    assert not bounded.feasible((10, 10, 7, 9)) and not bounded.feasible((10, 10, 5, 7))
+    design = bounded.optimize(p)
+    assert 2 <= design.params['T'] <= 6 and 8 <= design.params['D2'] <= 12
+
+import threading
+from gipreview import Preview
+
+def test_preview():
+    frames = []
+    preview = Preview(frames.append, _coarse_rays=100, _coarse_M=21, _stages=(4, 1))
+    params = dict(R1=10, R2=10, T=5, OD=5, D2=9, h=10, M=51, D=500, N=2000)
+
+    # a coarse frame first, then the exact trace.
+    coarse = preview.request(params)
+    assert coarse.psf.shape == (21, 21) and coarse.rays == 100 and not coarse.final
+    final = preview.wait()
+    assert final.final and final.rays == 2000 and not final.table
+    assert [frame.rays for frame in frames] == [100, 500, 2000]
+    camera = CameraModel(10, 10, 5, 5, 9, 10, 51, 500)
+    assert np.array_equal(final.psf, camera.sample_radial(2000).image())
+
+    # the lens is remembered, changing D2 goes through its table.
+    assert len(preview.tables) == 1
+    preview.request(dict(params, D2=8))
+    final = preview.wait()
+    assert final.table and final.params['D2'] == 8
+    camera = CameraModel(10, 10, 5, 5, 8, 10, 51, 500)
+    assert abs(final.psf.sum() - camera.sample_radial(2000).image().sum()) < 1e-3 * final.psf.sum()
+
+    # a newer request makes the old one stale.
+    frames.clear()
+    preview.request(dict(params, R1=11))
+    preview.request(dict(params, R1=12))
+    preview.wait()
+    seen = [frame.params['R1'] for frame in frames]
+    assert seen[seen.index(12):] == [12, 12, 12]
+    assert frames[-1].final and len(preview.tables) >= 2
+    assert Preview.lens_key(dict(params, R1=12)) in preview.tables
+
+    # frames are private arrays, not the shared RadialPSF expansions.
+    RadialPSF.expanded.clear()
+    frame = preview.request(dict(params, D=400))
+    assert frame.psf.flags.writeable and len(RadialPSF.expanded) == 0
+
+    # the table build runs on its own thread, so a newer request refines
+    # while it is going and a queued build of a stale lens is dropped.
+    started = threading.Event()
+    release = threading.Event()
+    preview.builder.submit(lambda: (started.set(), release.wait()))
+    started.wait()
+    preview.request(dict(params, R1=13))
+    preview.executor.submit(lambda: None).result(10)
+    preview.request(dict(params, R1=14))
+    preview.executor.submit(lambda: None).result(10)
+    final = preview.frame
+    assert final.final and final.params['R1'] == 14
+    release.set()
+    preview.wait()
+    assert Preview.lens_key(dict(params, R1=13)) not in preview.tables
+    assert Preview.lens_key(dict(params, R1=14)) in preview.tables
+    preview.close()
+
+from gibank import PSFBank
+
+def test_psf_bank(tmp_path):
+    path = str(tmp_path / "bank.npy")
+    Ds = [500, 1000, float('inf')]
+    D2s = [8.5, 9]
+    bank = PSFBank.build(path, 10, 10, 5, 5, 5, 21, 2000, Ds, D2s, _fields=[0, .01], _workers=2)
+    assert bank.shape() == (3, 2, 2, 1)
+    assert bank.psfs.dtype == np.float32 and bank.chiefs.shape == (3, 2, 2, 1, 2)
+
+    # entries match CameraModel.
+    camera = CameraModel(10, 10, 5, 5, 9, 5, 21, 1000)
+    chief = camera.sample_field(2000, (1000 * tan(.01), 0))
+    assert np.array_equal(bank.psfs[1, 1, 1, 0], camera.sensor.sensor.astype(np.float32))
+    assert np.allclose(bank.chiefs[1, 1, 1, 0], chief)
+
+    # a second reader shares the file without loading it.
+    reader = PSFBank(path)
+    assert isinstance(reader.psfs, np.memmap)
+    psf = reader.nearest(900, 8.9, .009)
+    assert not psf.flags.writeable
+    assert np.array_equal(psf, bank.psfs[1, 1, 1, 0])
+    assert reader.nearest_index(float('inf'), 8.5) == (2, 0, 0, 0)
+
+    # grid points are exact, in between is a blend, D is interpolated in 1 / D.
+    assert np.array_equal(reader.lookup(500, 8.5), bank.psfs[0, 0, 0, 0])
+    assert dict(reader.weights(2000, 9, 0, 587.56)) == {(1, 1, 0, 0): .5, (2, 1, 0, 0): .5}
+    halfway = reader.lookup(1000, 8.75, .005)
+    expected = sum(bank.psfs[1, j, k, 0].astype(float) for j in (0, 1) for k in (0, 1)) / 4
+    assert np.allclose(halfway, expected)
+    assert np.allclose(reader.chief(1000, 9, .005), bank.chiefs[1, 1, :, 0].mean(axis=0))
+
+    # a field angle lands in about the same place at every D, so blending
+    # across D stays between neighbours that agree.
+    chiefs = bank.chiefs[:, 1, 1, 0, 0]
+    assert np.all(chiefs < 0) and chiefs.max() - chiefs.min() < .1 * abs(chiefs).min()
+    camera = CameraModel(10, 10, 5, 5, 9, 5, 21, float('inf'))
+    assert np.allclose(bank.chiefs[2, 1, 1, 0], camera.chief_ray((tan(.01), 0)))
+
+    # clamped outside the grid.
+    assert np.array_equal(reader.lookup(100, 20, -.05), bank.psfs[0, 1, 0, 0])
+
+from gisampling import PupilSequence, radicalInverse
+from gicameramodel import Partial
+
+def test_sharded_sampling(tmp_path):
+    assert radicalInverse([1, 2, 3, 4], 2).tolist() == [.5, .25, .75, .125]
+
+    # blocks only depend on the seed and their index.
+    for kind in PupilSequence.KINDS:
+        sequence = PupilSequence(1000, kind, 7, 2, 100)
+        assert sum(len(sequence.shard(i, 3)) for i in range(3)) == sequence.blocks
+        again = PupilSequence(1000, kind, 7, 2, 100)
+        assert np.array_equal(sequence.block(5), again.block(5))
+        assert not np.array_equal(sequence.block(5), PupilSequence(1000, kind, 8, 2, 100).block(5))
+        points = np.concatenate([sequence.block(b) for b in range(sequence.blocks)])
+        assert abs(len(points) - 1000) < 60 and np.all(np.sum(points * points, axis=1) <= 1)
+    fan = np.concatenate([PupilSequence(100, 'jittered', 0, 1, 30).block(b) for b in range(4)])
+    assert np.all(np.floor((fan[:, 0] + 1) * 50) == np.arange(100))
+
+    # merged shards in any order are bit identical to one process.
+    for grid in (True, False):
+        for kind in ('jittered', 'halton'):
+            single = CameraModel(10, 10, 5, 5, 9, 5, 31, 500)
+            whole = single.sample_stratified(5000, kind, 3, grid, _block=256)
+            assert whole.complete() and whole.rays == whole.counts.sum() + single.lens_miss
+
+            sharded = CameraModel(10, 10, 5, 5, 9, 5, 31, 500)
+            partials = [sharded.sample_shard(5000, i, 4, kind, 3, grid, 256) for i in range(4)]
+            assert not partials[0].complete()
+            partials[1].save(str(tmp_path / "partial.npz"))
+            partials[1] = Partial.load(str(tmp_path / "partial.npz"))
+            merged = sharded.accumulate(partials[::-1])
+            assert merged.rays == whole.rays and merged.complete()
+            assert np.array_equal(sharded.sensor.sensor, single.sensor.sensor)
+
+    with pytest.raises(ValueError):
+        Partial.merge([partials[0], partials[0]])
+    other = sharded.sample_shard(5000, 1, 4, 'jittered', 4, False, 256)
+    with pytest.raises(ValueError):
+        Partial.merge([partials[0], other])
@@ -0,0 +1,134 @@
+'''
+    A precomputed ray transfer table for a Lens.
+    For a rotationally symmetric lens a meridional ray is fully described
+    by its height and slope on the plane of the front vertex. The table maps
+    that pair to the height and slope on the plane of the back vertex, so a
+    sweep over D and D2 only pays for propagation and a table lookup.
+
+    Slopes are dy / dl where l is the distance travelled along the axis
+    towards the sensor.
+'''
+import numpy as np
+from math import isinf, sqrt
+from gimath import RayBatch
+from gicameramodel import Sensor
+
+## A grid of exact traces through a lens with bilinear interpolation.
+# The grid reaches a little past the aperture. Lookups in cells where every
+# corner is lost are lost, and so are rays too far off axis to reach the
+# aperture. Lookups in cells where only some corners are lost, or that fall
+# outside the grid, are traced exactly.
+class TransferTable:
+    def __init__(self, _lens, _max_slope=.25, _heights=513, _slopes=513, _wavelength=None):
+        ## Constructer. Traces the grid and measures the interpolation error.
+        # @param _lens the Lens.
+        # @param _max_slope the largest input slope the table covers.
+        # @param _heights number of grid heights over the aperture.
+        # @param _slopes number of grid slopes over [-_max_slope, _max_slope].
+        # @param _wavelength optional wavelength in nm for a dispersive lens.
+        self.lens = _lens
+        self.wavelength = _wavelength
+        self.heights = np.linspace(-1.1 * _lens.aperture, 1.1 * _lens.aperture, _heights)
+        self.slopes = np.linspace(-_max_slope, _max_slope, _slopes)
+        # how far behind the front vertex plane the surface is at the aperture.
+        self.sag = _lens.R1 - sqrt(_lens.R1 ** 2 - _lens.aperture ** 2)
+
+        h, s = np.meshgrid(self.heights, self.slopes, indexing='ij')
+        out_h, out_s = self.exact(h.ravel(), s.ravel())
+        self.out_heights = out_h.reshape(h.shape)
+        self.out_slopes = out_s.reshape(h.shape)
+
+        # bilinear interpolation is worst in the middle of a cell.
+        mid_h, mid_s = np.meshgrid((self.heights[1:] + self.heights[:-1]) / 2,
+                                   (self.slopes[1:] + self.slopes[:-1]) / 2, indexing='ij')
+        exact_h, exact_s = self.exact(mid_h.ravel(), mid_s.ravel())
+        table_h, table_s, _ = self.interpolate(mid_h.ravel(), mid_s.ravel())
+        used = ~np.isnan(table_h) & ~np.isnan(exact_h)
+        ## @var height_error
+        # Largest height error in mm seen at the cell centers.
+        self.height_error = float(np.max(np.abs(table_h - exact_h)[used], initial=0))
+        ## @var slope_error
+        # Largest slope error seen at the cell centers.
+        self.slope_error = float(np.max(np.abs(table_s - exact_s)[used], initial=0))
+
+    def exact(self, _heights, _slopes):
+        ## Traces rays through the lens. Lost rays are nan.
+        # @return (heights, slopes) on the back vertex plane.
+        T = self.lens.T
+        origins = np.column_stack((np.full(len(_heights), T / 2), _heights))
+        directions = np.column_stack((-np.ones(len(_heights)), _slopes))
+        wavelengths = None if self.wavelength is None else np.full(len(_heights), self.wavelength)
+        out = self.lens.refract_batch(RayBatch(origins, directions), wavelengths)
+        return (out.getY(-T / 2), out.directions[:, 1] / -out.directions[:, 0])
+
+    def interpolate(self, _heights, _slopes):
+        ## Bilinear lookup only. nan outside the grid or next to a lost ray.
+        # @return (heights, slopes, lost) where lost marks cells with every
+        # corner lost.
+        fh = (_heights - self.heights[0]) / (self.heights[1] - self.heights[0])
+        fs = (_slopes - self.slopes[0]) / (self.slopes[1] - self.slopes[0])
+        inside = (fh >= 0) & (fh <= len(self.heights) - 1) & (fs >= 0) & (fs <= len(self.slopes) - 1)
+
+        i = np.clip(np.floor(np.where(inside, fh, 0)).astype(int), 0, len(self.heights) - 2)
+        j = np.clip(np.floor(np.where(inside, fs, 0)).astype(int), 0, len(self.slopes) - 2)
+        a = fh - i
+        b = fs - j
+
+        result = []
+        for table in (self.out_heights, self.out_slopes):
+            corners = (table[i, j], table[i + 1, j], table[i, j + 1], table[i + 1, j + 1])
+            value = ((1 - a) * (1 - b) * corners[0] + a * (1 - b) * corners[1]
+                     + (1 - a) * b * corners[2] + a * b * corners[3])
+            result.append(np.where(inside, value, np.nan))
+
+        lost = inside & np.isnan(corners[0]) & np.isnan(corners[1]) & np.isnan(corners[2]) & np.isnan(corners[3])
+        return (result[0], result[1], lost)
+
+    def lookup(self, _heights, _slopes):
+        ## Maps front vertex heights and slopes to back vertex heights and slopes.
+        # @param _heights array of heights on the front vertex plane.
+        # @param _slopes array of slopes.
+        # @return (heights, slopes). Rays lost in the lens are nan.
+        heights = np.asarray(_heights, dtype=float)
+        slopes = np.asarray(_slopes, dtype=float)
+        out_h, out_s, lost = self.interpolate(heights, slopes)
+
+        # a ray can only move |slope| * sag closer to the axis before it
+        # reaches the front surface.
+        lost |= np.abs(heights) - np.abs(slopes) * self.sag > self.lens.aperture
+        fallback = np.isnan(out_h) & ~lost
+        if np.any(fallback):
+            out_h[fallback], out_s[fallback] = self.exact(heights[fallback], slopes[fallback])
+        return (out_h, out_s)
+
+    def fan(self, _D, _N):
+        ## Returns the (heights, slopes) on the front vertex plane of the fan
+        # CameraModel.launch_fan fires, the same cone from Lens.cone_angle.
+        # @param _D distance from the source to the front vertex, may be inf.
+        # @param _N number of rays.
+        samples = np.linspace(-1, 1, num = _N)
+        if isinf(_D):
+            return (samples * self.lens.stop_radius(), np.zeros(_N))
+        slopes = np.tan(self.lens.cone_angle(_D) * samples)
+        return (_D * slopes, slopes)
+
+    def sensor_heights(self, _D, _D2, _N):
+        ## Returns where the fan of sample_point_source lands on a sensor at _D2.
+        # @param _D distance from the source to the front vertex, may be inf.
+        # @param _D2 distance from the back vertex to the sensor.
+        # @param _N number of rays.
+        heights, slopes = self.fan(_D, _N)
+        out_h, out_s = self.lookup(heights, slopes)
+        return out_h + _D2 * out_s
+
+    def psf(self, _D, _D2, _h, _M, _N):
+        ## Returns the sensor sample_point_source would give, using the table.
+        # @param _D distance from the source to the front vertex, may be inf.
+        # @param _D2 distance from the back vertex to the sensor.
+        # @param _h sensor height.
+        # @param _M number of pixels on the sensor.
+        # @param _N number of rays.
+        sensor = Sensor(_h, _M)
+        sensor.write_many(self.sensor_heights(_D, _D2, _N))
+        sensor.rotate()
+        return sensor.sensor
@@ -0,0 +1,165 @@
+'''
+    Diffraction PSFs from the pupil function.
+    A fan of rays is traced through the lens, or any gisystem.System, and followed to a reference
+    sphere centered on the middle of the sensor. Their optical path
+    differences give the wavefront over the exit pupil, and the PSF is the
+    squared magnitude of its padded FFT, binned to sensor pixels.
+
+    The lens is rotationally symmetric and the source on axis, so the
+    wavefront only depends on the height on the reference sphere and one
+    meridional fan is enough. FFT plans and pupil grids are kept in small
+    LRUs. Pupil grids are kept in units of the sample spacing, so the steps
+    of a focus sweep share them and a PSF costs one fan trace and one FFT.
+'''
+import numpy as np
+from math import ceil, pi
+from collections import OrderedDict
+from gimath import RayBatch
+from giglass import D_LINE
+from giimage import fast_length
+
+## @var plans
+# LRU of (n_fft, oversampling, pupil spacing) keyed by the rounded optical setup.
+plans = OrderedDict()
+## @var max_plans
+# How many plans are kept.
+max_plans = 64
+
+## @var grids
+# LRU of pupil radius maps in samples, keyed by their size. See pupil_grid.
+grids = OrderedDict()
+## @var max_grids
+# How many pupil grids are kept.
+max_grids = 4
+
+def remember(_cache, _key, _value, _max):
+    ## Puts a value in an LRU, dropping the least recently used past _max.
+    _cache[_key] = _value
+    while len(_cache) > _max:
+        _cache.popitem(last=False)
+    return _value
+
+def plan(_a, _R, _wavelength, _pixel, _samples):
+    ## Returns (n_fft, s, dx) for a pupil of radius _a sampled _samples times
+    # across, so the FFT gives an image s times finer than the sensor pixels.
+    # s is picked so the FFT is at least twice the pupil, which keeps the
+    # intensity from aliasing, and odd so a pixel is centered on the axis.
+    # n_fft is s times a fast length, so the fine samples split into whole
+    # pixels, and the pupil spacing dx is nudged so the image spacing is
+    # exactly _pixel / s.
+    # @param _a pupil radius in mm.
+    # @param _R reference sphere radius in mm.
+    # @param _wavelength wavelength in mm.
+    # @param _pixel sensor pixel size in mm.
+    # @param _samples pupil samples across the diameter.
+    key = tuple(round(float(v), 12) for v in (_a, _R, _wavelength, _pixel)) + (_samples,)
+    if key in plans:
+        plans.move_to_end(key)
+        return plans[key]
+    dx = 2 * _a / _samples
+    s = max(1, ceil(4 * _a * _pixel / (_wavelength * _R))) | 1
+    n_fft = s * fast_length(ceil(_wavelength * _R / (dx * _pixel)))
+    return remember(plans, key, (n_fft, s, s * _wavelength * _R / (n_fft * _pixel)), max_plans)
+
+def pupil_grid(_m, _dx):
+    ## Returns the _m x _m map of distances from the middle of the pupil.
+    # The map in samples is shared by every spacing and only scaled here,
+    # and a smaller odd map is the middle of a larger one, so the focus
+    # steps of a sweep all cut theirs from the same cached map.
+    sizes = [size for size in grids if size >= _m and (size - _m) % 2 == 0]
+    if sizes:
+        size = min(sizes)
+        grids.move_to_end(size)
+        samples = grids[size]
+    else:
+        # rounded up so the next few larger maps fit too.
+        size = 2 * (64 * ceil(_m // 2 / 64)) + 1
+        u = np.arange(size) - size // 2
+        samples = remember(grids, size, np.hypot(u[:, None], u[None, :]), max_grids)
+    k = (size - _m) // 2
+    return samples[k:k + _m, k:k + _m] * _dx
+
+def wavefront(_camera, _wavelength=D_LINE, _rays=1025):
+    ## Traces a meridional fan and returns the wavefront on the reference sphere.
+    # @param _camera the CameraModel.
+    # @param _wavelength wavelength in nm.
+    # @param _rays number of rays from the axis to the edge of the launch fan.
+    # @return (heights, opd, R) in mm. The heights and opd of the rays that
+    # make it through sorted by height, opd relative to the axial ray, and
+    # the radius of the reference sphere.
+    camera = _camera
+    lens = camera.lens
+    pupil = np.linspace(0, 1, _rays)[:, None]
+    origins, directions = camera.launch(pupil)
+    rays = RayBatch(origins, directions)
+    segments = lens.trace_batch(rays, np.full(_rays, float(_wavelength)), camera.stats)
+    n = lens.indices(float(_wavelength))
+
+    # a collimated fan starts on a plane, so its paths start on the same wavefront.
+    path = np.zeros(_rays)
+    start = rays.origins
+    for i, segment in enumerate(segments):
+        path += n[i] * np.linalg.norm(segment.origins - start, axis=1)
+        start = segment.origins
+    out = segments[-1]
+
+    # the reference sphere is centered on the sensor and touches the back vertex.
+    R = -lens.T / 2 - camera.sensor_pos
+    center = np.array([camera.sensor_pos, 0.])
+    d = out.directions
+    q = out.origins - center
+    b = np.einsum('ij,ij->i', d, q)
+    t = -b - np.sqrt(b * b - np.einsum('ij,ij->i', q, q) + R * R)
+    heights = np.abs(out.origins[:, 1] + t * d[:, 1])
+    opd = path + n[-1] * t
+
+    ok = ~np.isnan(opd)
+    if not ok[0]:
+        raise ValueError("the axial ray did not make it through the lens")
+    heights, opd = heights[ok], opd[ok] - opd[0]
+    order = np.argsort(heights)
+    return (heights[order], opd[order], R)
+
+def center_crop(_image, _M):
+    ## Returns the _M x _M middle of a square image, padded with zeros if smaller.
+    n = _image.shape[0]
+    out = np.zeros((_M, _M))
+    half = min((n - 1) // 2, _M // 2)
+    out[_M // 2 - half:_M // 2 + half + 1, _M // 2 - half:_M // 2 + half + 1] = \
+        _image[n // 2 - half:n // 2 + half + 1, n // 2 - half:n // 2 + half + 1]
+    return out
+
+def diffraction_psf(_camera, _wavelength=D_LINE, _samples=None, _max_samples=1024, _rays=1025):
+    ## Returns the M x M diffraction PSF of a camera, normalized to sum to 1
+    # over the whole FFT plane.
+    # @param _camera the CameraModel.
+    # @param _wavelength wavelength in nm.
+    # @param _samples pupil samples across the diameter. By default enough
+    # for the wavefront to change less than half a wave between samples.
+    # @param _max_samples the most pupil samples picked by default.
+    # @param _rays rays in the traced fan.
+    heights, opd, R = wavefront(_camera, _wavelength, _rays)
+    wavelength = _wavelength * 1e-6
+    a = heights[-1]
+    if _samples is None:
+        slope = np.max(np.abs(np.gradient(opd, heights)), initial=0) if len(heights) > 1 else 0
+        # rounded up so nearby focus steps share a plan.
+        _samples = int(min(_max_samples, 32 * max(2, ceil(a * slope / (4 * wavelength)))))
+
+    sensor = _camera.sensor
+    n_fft, s, dx = plan(a, R, wavelength, sensor.h / sensor.M, _samples)
+    m = 2 * int(a / dx) + 1
+    r = pupil_grid(m, dx)
+    inside = r <= a
+    field = np.zeros((m, m), dtype=complex)
+    field[inside] = np.exp(2j * pi / wavelength * np.interp(r[inside], heights, opd))
+
+    intensity = np.abs(np.fft.fft2(field, (n_fft, n_fft))) ** 2
+    intensity /= intensity.sum()
+
+    # bin s x s fine samples into pixels. s is odd, so rolling the axis to
+    # the middle of the first s samples centers every bin on a pixel.
+    intensity = np.roll(intensity, (s // 2, s // 2), axis=(0, 1))
+    nb = n_fft // s
+    binned = intensity.reshape(nb, s, nb, s).sum(axis=(1, 3))
+    return center_crop(np.fft.fftshift(binned), sensor.M)